@@ -0,0 +1,136 @@
+# Time each stage of the McNemar pipeline on synthetic cohorts loaded into a local engine.
+# Usage: python -m hbs.benchmark --sizes 10000 100000 1000000 --output bench.csv [--baseline previous.csv]
+#        python -m hbs.benchmark --imports [--import-budget 1.0]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from hbs.instrumentation import recording, stage_labels
+from hbs.synthetic import load_synthetic_cohort
+from hbs.utils import create_local_engine, get_mcnemar_test_inputs, get_mcnemar_contingency_table, \
+    get_mcnemar_stats
+
+# modules that must import without heavy_dependencies, e.g. in worker processes and short CLI runs
+lightweight_modules = ['hbs.queries', 'hbs.instrumentation', 'hbs.stats', 'hbs.utils', 'hbs.parallel', 'hbs.permutation']
+heavy_dependencies = ['sqlalchemy', 'statsmodels', 'scipy']
+
+
+def time_pipeline_stages(engine, years, category='dementia', baseline=True):
+    """
+    Time the stages of get_mcnemar_test_inputs -> get_mcnemar_contingency_table -> McNemar test for each year,
+    as recorded by hbs.instrumentation.
+    :return: DataFrame with one row per (year, stage): seconds and rows produced
+    """
+    # scipy is imported on the first McNemar test; import it up front so the first year's stage is not charged
+    get_mcnemar_stats(np.zeros((1, 2, 2), dtype=np.int64))
+    with recording() as recorder:
+        for year in years:
+            with stage_labels(year=year):
+                pairs = get_mcnemar_test_inputs(year, category, engine, baseline=baseline)
+                get_mcnemar_stats(get_mcnemar_contingency_table(pairs, category=category))
+    stages = recorder.to_frame()
+    # the two queries of a year are told apart by the side label set in get_mcnemar_test_inputs
+    queries = stages['stage'] == 'query'
+    stages.loc[queries, 'stage'] = 'query_' + stages.loc[queries, 'side']
+    return stages[['year', 'stage', 'seconds', 'rows']]
+
+
+def time_imports(modules=None, repeat=5):
+    """
+    Time a cold import of each module in a fresh interpreter.
+    :param modules: modules to import (defaults to lightweight_modules)
+    :return: DataFrame with the median seconds over repeat runs and the heavy_dependencies each import loaded
+    """
+    script = ("import sys, time; start = time.perf_counter(); import {module}; "
+              "print(time.perf_counter() - start); print(' '.join(m for m in {heavy!r} if m in sys.modules))")
+    # run from the repository root so hbs resolves to this checkout
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for module in lightweight_modules if modules is None else modules:
+        seconds = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', script.format(module=module, heavy=heavy_dependencies)],
+                                    cwd=root, capture_output=True, text=True, check=True).stdout.split('\n')
+            seconds.append(float(output[0]))
+        results.append({'module': module, 'seconds': pd.Series(seconds).median(), 'loaded': output[1]})
+    return pd.DataFrame(results)
+
+
+def run_benchmark(sizes=(10000, 100000, 1000000), n_years=30, years=None, category='dementia', backend='sqlite',
+                  workdir=None, seed=0):
+    """
+    Generate and load a synthetic cohort for every size, then time each pipeline stage over the given years.
+    :param sizes: cohort sizes in profiles
+    :param years: years to time (defaults to all n_years)
+    :param workdir: directory for the database files (defaults to a temporary directory)
+    :return: DataFrame of total seconds and rows per (n_profiles, stage), including the load time
+    """
+    years = range(1, n_years + 1) if years is None else years
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        for n_profiles in sizes:
+            engine = create_local_engine(os.path.join(tmpdir, f"hbs_{n_profiles}.{backend}"), backend=backend)
+            start = time.perf_counter()
+            tables = load_synthetic_cohort(engine, n_profiles=n_profiles, n_years=n_years, seed=seed)
+            results.append({'n_profiles': n_profiles, 'stage': 'load', 'seconds': time.perf_counter() - start,
+                            'rows': sum(len(df) for df in tables.values())})
+            del tables
+            stages = time_pipeline_stages(engine, years, category=category)
+            totals = stages.groupby('stage', sort=False)[['seconds', 'rows']].sum().reset_index()
+            totals.insert(0, 'n_profiles', n_profiles)
+            results.extend(totals.to_dict('records'))
+            engine.dispose()
+    return pd.DataFrame(results)
+
+
+def compare_benchmarks(current, baseline, tolerance=1.5):
+    """Return the (n_profiles, stage) rows of current that are more than tolerance times slower than baseline."""
+    merged = pd.merge(current, baseline, on=['n_profiles', 'stage'], suffixes=('', '_baseline'))
+    merged['ratio'] = merged['seconds'] / merged['seconds_baseline']
+    return merged[merged['ratio'] > tolerance].reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the McNemar pipeline on synthetic cohorts.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--years', type=int, default=30)
+    parser.add_argument('--category', default='dementia')
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'duckdb'])
+    parser.add_argument('--output', help='CSV file to write the results to')
+    parser.add_argument('--baseline', help='CSV of a previous run; exit with status 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--imports', action='store_true',
+                        help='time module imports instead; exit with status 1 if a lightweight module loads a '
+                             'heavy dependency or exceeds --import-budget')
+    parser.add_argument('--import-budget', type=float, help='maximum seconds per module import')
+    args = parser.parse_args(argv)
+    if args.imports:
+        imports = time_imports()
+        print(imports.to_string(index=False))
+        slow = imports['seconds'] > args.import_budget if args.import_budget else False
+        failed = imports[(imports['loaded'] != '') | slow]
+        if len(failed):
+            print('Regressions:')
+            print(failed.to_string(index=False))
+            return 1
+        return 0
+    results = run_benchmark(sizes=args.sizes, n_years=args.years, category=args.category, backend=args.backend)
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    if args.baseline:
+        regressions = compare_benchmarks(results, pd.read_csv(args.baseline), tolerance=args.tolerance)
+        if len(regressions):
+            print('Regressions:')
+            print(regressions.to_string(index=False))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import pandas as pd
+from hbs.queries import hbs_tables
+from hbs.utils import write_atomic
+
+
+class ResultCache:
+    """
+    On-disk Parquet cache for query results, keyed by query text, engine URL and data version.
+    Files are evicted least-recently-used first once the cache grows past max_bytes.
+    Parquet support requires pyarrow (or fastparquet).
+    """
+
+    def __init__(self, cache_dir='.hbs_cache', max_bytes=2 * 1024 ** 3, data_version=None):
+        """
+        :param cache_dir: directory holding the cached results
+        :param max_bytes: size limit of the cache directory
+        :param data_version: user-supplied version string or table checksum (see get_table_checksum);
+            changing it invalidates every cached result
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.data_version = data_version
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, query, engine):
+        """Return the cache key of a query run against an engine."""
+        url = engine.url.render_as_string(hide_password=True)
+        text = '\0'.join([str(self.data_version), url, query])
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.parquet')
+
+    def get(self, key):
+        """Return the cached DataFrame for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            df = pd.read_parquet(path)
+        except FileNotFoundError:
+            return None
+        # mtime records the last access for LRU eviction; another process may have evicted the file since the read
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return df
+
+    def put(self, key, df):
+        """Store df under key, then evict old entries if the cache is over its size limit."""
+        write_atomic(self._path(key), lambda tmp_path: df.reset_index(drop=True).to_parquet(tmp_path, index=False))
+        self.evict()
+
+    def read_sql(self, query, engine):
+        """Drop-in replacement for pd.read_sql(query, con=engine) that reads through the cache."""
+        key = self.key(query, engine)
+        df = self.get(key)
+        if df is None:
+            df = pd.read_sql(query, con=engine)
+            self.put(key, df)
+        return df
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.parquet'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return sorted(entries)
+
+    def size(self):
+        """Total size in bytes of the cached results."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Remove least recently used results until the cache fits in max_bytes."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove every cached result."""
+        for _, _, name in self._entries():
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+def get_table_checksum(engine, tables=None):
+    """
+    Return a version string for the hbs tables, for use as ResultCache data_version.
+    Uses MySQL CHECKSUM TABLE, which reads every row but is far cheaper than rerunning the analysis.
+    """
+    tables = hbs_tables if tables is None else tables
+    checksums = pd.read_sql(f"CHECKSUM TABLE {', '.join('hbs.' + t for t in tables)};", con=engine)
+    return hashlib.sha256(checksums.to_csv(index=False).encode('utf-8')).hexdigest()
@@ -0,0 +1,149 @@
+# Run the McNemar grid from the command line, resuming from checkpoints after an interruption.
+# Usage: python -m hbs.cli --years 1-30 --categories dementia --arms baseline simulated --output-dir data
+#        python -m hbs.cli --access sqlite --path hbs.db --years 1-30 --workers 8 --output-dir data
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import numpy as np
+from hbs.parallel import map_tasks
+from hbs.queries import flag_names
+from hbs.utils import create_engine_to_hbs, get_mcnemar_test_inputs_arms, get_mcnemar_contingency_table, \
+    get_mcnemar_stats, write_atomic
+
+# engine of a worker process, created by _init_worker since engines cannot be pickled
+_worker_engine = None
+
+
+def _init_worker(access, path):
+    global _worker_engine
+    _worker_engine = create_engine_to_hbs(access=access, pool_size=1, path=path)
+
+
+def _run_year(year, categories, arms, control_sampling, seed):
+    # contingency counts of every (category, arm) cell of a year; the control side is fetched once
+    pairs = get_mcnemar_test_inputs_arms(year, list(categories), _worker_engine, arms=arms,
+                                         control_sampling=control_sampling, seed=seed)
+    cells = []
+    for arm in arms:
+        for category in categories:
+            (n11, n10), (n01, n00) = get_mcnemar_contingency_table(pairs[arm], category=category).tolist()
+            cells.append({'arm': arm, 'category': category, 'year': int(year),
+                          'n11': n11, 'n10': n10, 'n01': n01, 'n00': n00})
+    return cells
+
+
+def _checkpoint_path(checkpoint_dir, arm, category, year):
+    return os.path.join(checkpoint_dir, f"{arm}_{category}_{year}.json")
+
+
+def _read_checkpoint(path, settings):
+    # counts of a finished cell, or None if it is missing or was computed with other settings
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        cell = json.load(f)
+    return cell if cell.pop('settings') == settings else None
+
+
+def _write_checkpoint(path, cell, settings):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump({**cell, 'settings': settings}, f)
+
+    write_atomic(path, write)
+
+
+def run_grid(years, categories, arms, access='remote', path=None, output_dir='data', date=None, max_workers=None,
+             control_sampling='server', seed=52):
+    """
+    Run the McNemar tests of every (year, category, arm) cell on a process pool and write one results file per arm,
+    {arm}_mcnemar_results_{date}.csv in output_dir, laid out as in data/ (year, pvalue, statistic, plus category
+    first when there are several categories).
+    Every finished cell is checkpointed under output_dir/checkpoints_{date}, so rerunning the same command after an
+    interruption only computes the missing cells. Each year is one task and fetches all its cells in one pass.
+    :param access: 'remote' or 'local' MySQL server, or 'sqlite' / 'duckdb' for a file-backed copy at path;
+        every worker process creates its own engine
+    :param max_workers: processes to spread years over (see hbs.parallel.map_tasks)
+    :return: dict of arm -> path of the written results file, and the list of years computed in this run
+    """
+    years, categories, arms = [int(year) for year in years], list(categories), list(arms)
+    date = date or datetime.date.today().isoformat()
+    checkpoint_dir = os.path.join(output_dir, f"checkpoints_{date}")
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    # the database is part of the settings so checkpoints of another database are recomputed
+    settings = {'access': access, 'path': path, 'control_sampling': control_sampling, 'seed': seed}
+
+    cells = {}
+    for arm in arms:
+        for category in categories:
+            for year in years:
+                cell = _read_checkpoint(_checkpoint_path(checkpoint_dir, arm, category, year), settings)
+                if cell is not None:
+                    cells[(arm, category, year)] = cell
+    todo = [year for year in years
+            if any((arm, category, year) not in cells for arm in arms for category in categories)]
+
+    def save(year_cells):
+        for cell in year_cells:
+            _write_checkpoint(_checkpoint_path(checkpoint_dir, cell['arm'], cell['category'], cell['year']),
+                              cell, settings)
+            cells[(cell['arm'], cell['category'], cell['year'])] = cell
+
+    # years are checkpointed as they complete; no engine is created when every cell is checkpointed
+    tasks = [(year, categories, arms, control_sampling, seed) for year in todo]
+    for year_cells in map_tasks(_run_year, tasks, max_workers=max_workers, initializer=_init_worker,
+                                initargs=(access, path), ordered=False):
+        save(year_cells)
+
+    written = {}
+    for arm in arms:
+        keys = [(arm, category, year) for category in categories for year in years]
+        tables = np.array([[[cells[key]['n11'], cells[key]['n10']], [cells[key]['n01'], cells[key]['n00']]]
+                           for key in keys])
+        results = get_mcnemar_stats(tables)[['pvalue', 'statistic']]
+        results.insert(0, 'year', [year for _, _, year in keys])
+        if len(categories) > 1:
+            results.insert(0, 'category', [category for _, category, _ in keys])
+        written[arm] = os.path.join(output_dir, f"{arm}_mcnemar_results_{date}.csv")
+        write_atomic(written[arm], lambda tmp_path: results.to_csv(tmp_path, index=False))
+    return written, todo
+
+
+def _parse_years(values):
+    # years given as numbers and inclusive ranges, e.g. 1-25 28 30
+    years = []
+    for value in values:
+        start, _, end = value.partition('-')
+        years.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(years))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run matched-pair McNemar tests over a grid of years, '
+                                                 'categories and arms.')
+    parser.add_argument('--years', nargs='+', default=['1-30'], help='years and ranges, e.g. 1-30 or 1 2 5-8')
+    parser.add_argument('--categories', nargs='+', default=['dementia'], choices=list(flag_names))
+    parser.add_argument('--arms', nargs='+', default=['baseline', 'simulated'], choices=['baseline', 'simulated'])
+    parser.add_argument('--access', default='remote', choices=['local', 'remote', 'sqlite', 'duckdb'])
+    parser.add_argument('--path', help='database file for --access sqlite or duckdb')
+    parser.add_argument('--output-dir', default='data')
+    parser.add_argument('--date', help='date in the results file names (defaults to today); reuse it to resume')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (defaults to all cores)')
+    parser.add_argument('--control-sampling', default='server', choices=['server', 'client', 'table'])
+    parser.add_argument('--seed', type=int, default=52)
+    args = parser.parse_args(argv)
+    years = _parse_years(args.years)
+    written, computed = run_grid(years, args.categories, args.arms, access=args.access, path=args.path,
+                                 output_dir=args.output_dir, date=args.date, max_workers=args.workers,
+                                 control_sampling=args.control_sampling, seed=args.seed)
+    print(f"{len(years) - len(computed)} of {len(years)} years checkpointed; computed {len(computed)}")
+    for arm, results_path in written.items():
+        print(f"{arm}: {results_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
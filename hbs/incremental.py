@@ -0,0 +1,133 @@
+# Incremental refresh of the dated McNemar result files in data/.
+# A JSON sidecar next to each results file stores a fingerprint per (category, year) of the source rows
+# that result depends on; a refresh recomputes only the partitions whose fingerprint changed.
+
+import hashlib
+import json
+import os
+import pandas as pd
+from hbs.cache import ResultCache
+from hbs.pipeline import run_mcnemar_series
+from hbs.queries import flag_names, get_partition_fingerprint_query, get_matched_profiles_fingerprint_query
+from hbs.store import arm_tables
+from hbs.utils import write_atomic
+
+
+def _records(df):
+    # aggregate rows as plain ints (MySQL returns DECIMAL sums), NULL as None
+    return [[None if pd.isna(v) else int(v) for v in row] for row in df.itertuples(index=False)]
+
+
+def get_partition_fingerprints(years, categories, arms, engine, control_sampling='server', seed=52):
+    """
+    Fingerprint the source data of every (arm, category, year) result with one aggregate query per flag table.
+    A result depends on matched_profiles, the arm's treated flags and the baseline control flags of its year,
+    and on the control sampling settings.
+    :return: dict of (arm, category, year) -> hex digest
+    """
+    dialect = engine.dialect.name
+    years = [int(year) for year in years]
+    matched_profiles = _records(pd.read_sql(get_matched_profiles_fingerprint_query(), con=engine))
+    aggregates = {}
+    for table in {arm_tables['baseline']} | {arm_tables[arm] for arm in arms}:
+        df = pd.read_sql(get_partition_fingerprint_query(years, table, dialect=dialect), con=engine)
+        df = df.set_index(df.columns[0])
+        aggregates[table] = {int(year): dict(zip(df.columns, _records(df.loc[[year]])[0])) for year in df.index}
+
+    def columns(table, year, flag):
+        # common columns and those of one flag; a year without rows fingerprints as None
+        row = aggregates[table].get(year)
+        if row is None:
+            return None
+        return {k: v for k, v in row.items() if not k.startswith(tuple(flag_names.values())) or k.startswith(flag)}
+
+    fingerprints = {}
+    for arm in arms:
+        for category in categories:
+            flag = flag_names[category]
+            for year in years:
+                source = {
+                    'matched_profiles': matched_profiles,
+                    'treated': columns(arm_tables[arm], year, flag),
+                    'control': columns(arm_tables['baseline'], year, flag),
+                    'control_sampling': control_sampling,
+                    'seed': seed,
+                }
+                digest = hashlib.sha256(json.dumps(source, sort_keys=True).encode('utf-8')).hexdigest()
+                fingerprints[(arm, category, year)] = digest
+    return fingerprints
+
+
+def load_fingerprints(path):
+    """Read a fingerprint sidecar as a dict of (category, year) -> digest; empty when the file does not exist."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        stored = json.load(f)
+    return {(category, int(year)): digest for category, year, digest in stored['fingerprints']}
+
+
+def save_fingerprints(path, fingerprints):
+    """Write a dict of (category, year) -> digest as a fingerprint sidecar."""
+    stored = {'fingerprints': [[category, year, digest] for (category, year), digest in sorted(fingerprints.items())]}
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(stored, f, indent=1)
+
+    write_atomic(path, write)
+
+
+def refresh_mcnemar_results(results_path, years, categories, arm, engine, fingerprint_path=None, max_workers=4,
+                            control_sampling='server', seed=52, cache=None):
+    """
+    Bring a results file (columns year, pvalue, statistic, plus category when there are several categories)
+    up to date, recomputing only the (category, year) partitions that are missing or whose source data changed.
+    Rows of years outside years are kept as they are.
+    :param results_path: CSV file such as data/simulated_mcnemar_results_2024-10-18.csv; created if missing
+    :param arm: 'baseline' or 'simulated'
+    :param fingerprint_path: sidecar file (defaults to results_path + '.fingerprints.json')
+    :param cache: optional hbs.cache.ResultCache; recomputed partitions are cached under their fingerprints
+    :return: the updated results DataFrame and the list of recomputed (category, year)
+    """
+    categories = [categories] if isinstance(categories, str) else list(categories)
+    fingerprint_path = fingerprint_path or results_path + '.fingerprints.json'
+    current = get_partition_fingerprints(years, categories, [arm], engine, control_sampling=control_sampling,
+                                         seed=seed)
+    current = {(category, year): digest for (_, category, year), digest in current.items()}
+    stored = load_fingerprints(fingerprint_path)
+
+    results = pd.read_csv(results_path) if os.path.exists(results_path) else \
+        pd.DataFrame(columns=['year', 'pvalue', 'statistic'])
+    if 'category' not in results.columns:
+        # files of a single category leave the category implicit
+        if len(categories) > 1 and len(results):
+            raise ValueError(f"{results_path} has no category column; refresh it with a single category")
+        results.insert(0, 'category', categories[0])
+    present = set(zip(results['category'], results['year']))
+    changed = [key for key in sorted(current) if stored.get(key) != current[key] or key not in present]
+    changed_keys = set(changed)
+
+    if changed:
+        changed_years = sorted({year for _, year in changed})
+        changed_categories = [category for category in categories if any(c == category for c, _ in changed)]
+        if cache is not None:
+            # cached queries are keyed by data_version; add the fingerprints of the refetched partitions so a
+            # changed partition is never read back from a result cached before the change
+            source = [[category, year, current[(category, year)]] for category in categories for year in changed_years]
+            version = hashlib.sha256(json.dumps([cache.data_version, source], default=str).encode('utf-8'))
+            cache = ResultCache(cache.cache_dir, max_bytes=cache.max_bytes, data_version=version.hexdigest())
+        stats = run_mcnemar_series(changed_years, changed_categories, [arm], engine, max_workers=max_workers,
+                                   control_sampling=control_sampling, seed=seed, cache=cache)['stats']
+        recomputed = stats[['category', 'year', 'pvalue', 'statistic']]
+        recomputed = recomputed[[key in changed_keys for key in zip(recomputed['category'], recomputed['year'])]]
+        keep = [key not in changed_keys for key in zip(results['category'], results['year'])]
+        results = pd.concat([results[keep], recomputed], ignore_index=True)
+        results = results.sort_values(['category', 'year'], kind='stable').reset_index(drop=True)
+
+    if results['category'].nunique() == 1:
+        results = results.drop(columns='category')
+    write_atomic(results_path, lambda tmp_path: results.to_csv(tmp_path, index=False))
+    # the sidecar is written last, so an interrupted refresh recomputes rather than trusts stale rows
+    save_fingerprints(fingerprint_path, {**stored, **current})
+    return results, changed
@@ -0,0 +1,191 @@
+# Inspect the query plans of hbs.queries and propose indexes for the hbs schema.
+# Usage: python -m hbs.indexes --access sqlite --path hbs.db [--create]
+
+import argparse
+import json
+import sys
+import pandas as pd
+from sqlalchemy import inspect
+from hbs.queries import hbs_tables, get_treated_subclass_query, get_control_subclass_query, \
+    get_treated_subclass_years_query, get_control_subclass_years_query, get_control_candidates_query, \
+    get_mcnemar_contingency_query, get_control_pairs_query, get_partition_fingerprint_query, \
+    get_matched_profiles_fingerprint_query, get_create_index_query
+from hbs.utils import create_engine_to_hbs
+
+# composite indexes serving the access paths of hbs.queries:
+# flag tables are joined on profile_id filtered by year and death_flag, matched_profiles is filtered
+# on treated and partitioned by subclass, and the pairing table is looked up by seed and year
+recommended_indexes = [
+    ('annual_matched_profile_flags', ('year', 'profile_id', 'death_flag')),
+    ('annual_simulated_treatment_flags', ('year', 'profile_id', 'death_flag')),
+    ('matched_profiles', ('treated', 'subclass', 'profile_id')),
+    ('matched_pairs_by_year', ('seed', 'year', 'subclass')),
+]
+
+
+def render_queries(dialect='mysql', years=(1, 2), category='dementia', seed=52, include_pairs=False):
+    """
+    Render every query builder of hbs.queries with representative arguments.
+    :param include_pairs: also render the queries reading hbs.matched_pairs_by_year
+    :return: dict of query name -> SQL
+    """
+    years = list(years)
+    rendered = {
+        'treated_subclass': get_treated_subclass_query(years[0], category, dialect=dialect),
+        'treated_subclass_simulated': get_treated_subclass_query(years[0], category, baseline=False, dialect=dialect),
+        'treated_subclass_streaming': get_treated_subclass_query(years[0], category, order_by_subclass=True,
+                                                                 dialect=dialect),
+        'control_subclass': get_control_subclass_query(years[0], category, dialect=dialect),
+        'treated_subclass_years': get_treated_subclass_years_query(years, category, dialect=dialect),
+        'control_subclass_years': get_control_subclass_years_query(years, category, dialect=dialect),
+        'control_candidates': get_control_candidates_query(years, category, dialect=dialect),
+        'mcnemar_contingency': get_mcnemar_contingency_query(years, category, dialect=dialect),
+        'matched_profiles_fingerprint': get_matched_profiles_fingerprint_query(),
+    }
+    for table in hbs_tables[1:]:
+        rendered[f'fingerprint_{table}'] = get_partition_fingerprint_query(years, table, dialect=dialect)
+    if include_pairs:
+        rendered['control_pairs'] = get_control_pairs_query(years, category, seed=seed, dialect=dialect)
+    return rendered
+
+
+def explain_query(query, engine):
+    """Return the query plan of a query as a DataFrame, in the dialect's own EXPLAIN format."""
+    dialect = engine.dialect.name
+    if dialect == 'sqlite':
+        return pd.read_sql('EXPLAIN QUERY PLAN ' + query, con=engine)
+    if dialect == 'duckdb':
+        plan = pd.read_sql('EXPLAIN (FORMAT json) ' + query, con=engine)
+        return _flatten_duckdb_plan(json.loads(plan['explain_value'].iloc[0]))
+    return pd.read_sql('EXPLAIN ' + query, con=engine)
+
+
+def _flatten_duckdb_plan(nodes, depth=0):
+    # one row per operator of a DuckDB JSON plan, depth first
+    rows = []
+    for node in nodes:
+        extra_info = node.get('extra_info', {})
+        rows.append({'depth': depth, 'operator': node['name'], 'table': extra_info.get('Table'),
+                     'filters': extra_info.get('Filters')})
+        rows.extend(_flatten_duckdb_plan(node.get('children', []), depth + 1).to_dict('records'))
+    return pd.DataFrame(rows, columns=['depth', 'operator', 'table', 'filters'])
+
+
+def find_plan_issues(plan, dialect):
+    """
+    List the full table scans and sorts in a plan from explain_query.
+    MySQL reports access type ALL and 'Using filesort'/'Using temporary'; SQLite reports SCAN of a table,
+    temporary B-trees and automatic (per-query) indexes; DuckDB reports sequential scans and sorts.
+    DuckDB only uses indexes for point lookups, so its scans are expected and listed for reference.
+    :return: list of dicts with table, issue and detail
+    """
+    issues = []
+    if dialect == 'sqlite':
+        # subqueries show up as CO-ROUTINE or MATERIALIZE and are scanned without being tables
+        subqueries = {detail.split(' ', 1)[1] for detail in plan['detail']
+                      if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+        for detail in plan['detail']:
+            words = detail.split(' ')
+            if words[0] == 'SCAN' and words[1] not in subqueries and not words[1].startswith('(') \
+                    and 'USING' not in words:
+                issues.append({'table': words[1], 'issue': 'full scan', 'detail': detail})
+            elif 'AUTOMATIC' in words:
+                issues.append({'table': words[1], 'issue': 'automatic index', 'detail': detail})
+            elif detail.startswith('USE TEMP B-TREE'):
+                issues.append({'table': None, 'issue': 'filesort', 'detail': detail})
+    elif dialect == 'duckdb':
+        for row in plan.itertuples():
+            if row.operator.strip() == 'SEQ_SCAN' and row.table is not None:
+                filters = row.filters if isinstance(row.filters, (str, list)) else 'none'
+                issues.append({'table': row.table, 'issue': 'full scan', 'detail': f"filters: {filters}"})
+            elif row.operator.strip() in ('ORDER_BY', 'TOP_N'):
+                issues.append({'table': None, 'issue': 'filesort', 'detail': row.operator})
+    else:
+        for row in plan.to_dict('records'):
+            extra = row.get('Extra') or ''
+            if row.get('type') == 'ALL':
+                issues.append({'table': row['table'], 'issue': 'full scan', 'detail': f"rows: {row.get('rows')}"})
+            if 'Using filesort' in extra:
+                issues.append({'table': row['table'], 'issue': 'filesort', 'detail': extra})
+            if 'Using temporary' in extra:
+                issues.append({'table': row['table'], 'issue': 'temporary', 'detail': extra})
+    return issues
+
+
+def get_existing_indexes(engine, tables=None):
+    """Return a dict of table -> list of indexed column tuples (primary keys included) in schema hbs."""
+    inspector = inspect(engine)
+    tables = [table for table, _ in recommended_indexes] if tables is None else tables
+    existing = {}
+    if engine.dialect.name == 'duckdb':
+        # duckdb_engine cannot reflect indexes; read them from the catalog and parse their columns
+        catalog = pd.read_sql("SELECT table_name, sql FROM duckdb_indexes() WHERE schema_name = 'hbs';", con=engine)
+        for table in tables:
+            if inspector.has_table(table, schema='hbs'):
+                existing[table] = [tuple(column.strip(' "') for column in sql.rsplit('(', 1)[1].split(')')[0].split(','))
+                                   for sql in catalog.loc[catalog['table_name'] == table, 'sql']]
+        return existing
+    for table in tables:
+        if not inspector.has_table(table, schema='hbs'):
+            continue
+        existing[table] = [tuple(index['column_names']) for index in inspector.get_indexes(table, schema='hbs')]
+        primary_key = inspector.get_pk_constraint(table, schema='hbs').get('constrained_columns')
+        if primary_key:
+            existing[table].append(tuple(primary_key))
+    return existing
+
+
+def propose_indexes(engine):
+    """Return the recommended indexes of existing tables that no existing index starts with."""
+    existing = get_existing_indexes(engine)
+    proposed = []
+    for table, columns in recommended_indexes:
+        if table in existing and not any(index[:len(columns)] == columns for index in existing[table]):
+            proposed.append((table, columns))
+    return proposed
+
+
+def create_indexes(engine, indexes=None):
+    """Create indexes, a list of (table, columns), defaulting to propose_indexes(engine). Return the created ones."""
+    indexes = propose_indexes(engine) if indexes is None else indexes
+    with engine.begin() as conn:
+        for table, columns in indexes:
+            conn.exec_driver_sql(get_create_index_query(table, list(columns), dialect=engine.dialect.name))
+    return indexes
+
+
+def advise_indexes(engine, years=(1, 2), category='dementia', seed=52):
+    """
+    Explain every rendered query on engine and report its full scans and sorts.
+    :return: DataFrame with one row per issue: query, table, issue, detail
+    """
+    include_pairs = inspect(engine).has_table('matched_pairs_by_year', schema='hbs')
+    rows = []
+    for name, query in render_queries(engine.dialect.name, years=years, category=category, seed=seed,
+                                      include_pairs=include_pairs).items():
+        for issue in find_plan_issues(explain_query(query, engine), engine.dialect.name):
+            rows.append({'query': name, **issue})
+    return pd.DataFrame(rows, columns=['query', 'table', 'issue', 'detail'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report full scans and sorts in the hbs query plans.')
+    parser.add_argument('--access', default='remote', choices=['local', 'remote', 'sqlite', 'duckdb'])
+    parser.add_argument('--path', help='database file for --access sqlite or duckdb')
+    parser.add_argument('--category', default='dementia')
+    parser.add_argument('--create', action='store_true', help='create the proposed indexes and report again')
+    args = parser.parse_args(argv)
+    engine = create_engine_to_hbs(access=args.access, path=args.path)
+    print(advise_indexes(engine, category=args.category).to_string(index=False))
+    proposed = propose_indexes(engine)
+    print('Proposed indexes:')
+    for table, columns in proposed:
+        print('   ', get_create_index_query(table, list(columns), dialect=engine.dialect.name))
+    if args.create and proposed:
+        create_indexes(engine, proposed)
+        print(advise_indexes(engine, category=args.category).to_string(index=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# Opt-in stage timing for the McNemar pipeline.
+# Nothing is recorded unless a recording() block is active:
+#
+#     with recording(callbacks=[JsonLinesWriter('stages.jsonl')]) as recorder:
+#         run_mcnemar_series(...)
+#     recorder.to_frame()
+
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+_active = None
+_local = threading.local()
+_listeners_installed = False
+
+
+class StageRecorder:
+    """
+    Collects one record per pipeline stage: stage name, labels (year, category, arm), wall time in seconds,
+    rows, bytes of the resulting DataFrame, database execute time for queries and, with track_memory=True,
+    peak traced memory (shared by all threads, so approximate when stages run concurrently).
+    """
+
+    def __init__(self, callbacks=(), track_memory=False):
+        self.records = []
+        self.callbacks = list(callbacks)
+        self.track_memory = track_memory
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """Call callback(record) for every record emitted from now on."""
+        self.callbacks.append(callback)
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def to_frame(self):
+        """Return the records as a DataFrame."""
+        return pd.DataFrame(self.records)
+
+    def write_jsonl(self, path):
+        """Write the records as JSON lines."""
+        with open(path, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+class JsonLinesWriter:
+    """Callback appending every record to a JSON lines file as it is emitted."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+def _install_listeners():
+    # time cursor execution separately from result transfer for every engine
+    global _listeners_installed
+    if _listeners_installed:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _local.execute_start = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        info = getattr(_local, 'info', None)
+        start = getattr(_local, 'execute_start', None)
+        if info is not None and start is not None:
+            info['execute_seconds'] = info.get('execute_seconds', 0.0) + time.perf_counter() - start
+
+    _listeners_installed = True
+
+
+@contextmanager
+def recording(recorder=None, callbacks=(), track_memory=False):
+    """Activate a StageRecorder (a new one unless given) for the duration of the block."""
+    global _active
+    recorder = recorder if recorder is not None else StageRecorder(callbacks=callbacks, track_memory=track_memory)
+    _install_listeners()
+    started_tracing = recorder.track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    previous, _active = _active, recorder
+    try:
+        yield recorder
+    finally:
+        _active = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+
+@contextmanager
+def stage_labels(**labels):
+    """Attach labels such as year, category or arm to the stages recorded in this thread inside the block."""
+    previous = getattr(_local, 'labels', {})
+    _local.labels = {**previous, **labels}
+    try:
+        yield
+    finally:
+        _local.labels = previous
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Time a pipeline stage. Yields a dict the caller may fill with 'rows' and 'bytes' (see measure),
+    or None when no recording is active.
+    """
+    recorder = _active
+    if recorder is None:
+        yield None
+        return
+    info = {}
+    previous_info = getattr(_local, 'info', None)
+    _local.info = info
+    if recorder.track_memory and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - start
+        _local.info = previous_info
+        peak_bytes = tracemalloc.get_traced_memory()[1] if recorder.track_memory and tracemalloc.is_tracing() else None
+        # frames passed to measure are sized after the clock stops, so sizing is not charged to the stage
+        frame = info.pop('frame', None)
+        if frame is not None:
+            info['rows'] = len(frame)
+            info['bytes'] = int(frame.memory_usage(deep=True).sum())
+        record = {'stage': name, **getattr(_local, 'labels', {}), **labels, 'start': start_time,
+                  'seconds': seconds, 'rows': info.get('rows'), 'bytes': info.get('bytes')}
+        if 'execute_seconds' in info:
+            record['execute_seconds'] = info['execute_seconds']
+            record['transfer_seconds'] = seconds - info['execute_seconds']
+        if peak_bytes is not None:
+            record['peak_bytes'] = peak_bytes
+        recorder.emit(record)
+
+
+def measure(info, df):
+    """
+    Record the row count and in-memory size of a DataFrame (a proxy for bytes transferred) on a stage's info.
+    Both are computed when the stage ends, after its time is taken.
+    """
+    if info is not None:
+        info['frame'] = df
+    return df
@@ -0,0 +1,26 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def map_tasks(function, tasks, max_workers=1, initializer=None, initargs=(), ordered=True):
+    """
+    Run function(*task) for every task on a process pool and yield the results.
+    Module-level state that workers need (an engine, a FlagStore, prepared arrays) is set by initializer(*initargs),
+    which runs once in every worker process, or once in the calling process when no pool is used.
+    :param max_workers: processes to spread tasks over (None for all cores); 1 or a single task runs in the calling
+        process, and no process is started for more than one per task
+    :param ordered: yield results in task order; False yields them as they complete
+    """
+    tasks = list(tasks)
+    max_workers = max_workers or os.cpu_count()
+    if max_workers == 1 or len(tasks) <= 1:
+        if tasks and initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield function(*task)
+        return
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks)), initializer=initializer,
+                             initargs=initargs) as executor:
+        futures = [executor.submit(function, *task) for task in tasks]
+        for future in futures if ordered else as_completed(futures):
+            yield future.result()
@@ -0,0 +1,55 @@
+import numpy as np
+from hbs.parallel import map_tasks
+from hbs.stats import get_mcnemar_contingency_tables, get_mcnemar_stats
+
+
+def _count_extreme(seed_sequence, discordant, observed, n_permutations, batch_size):
+    # permutations whose |n10 - n01| is at least the observed one, per table.
+    # flipping the treated/control labels of each discordant pair with probability 1/2 makes the number of
+    # 1-0 pairs Binomial(discordant, 1/2), so the flips are drawn as counts instead of per pair
+    rng = np.random.default_rng(seed_sequence)
+    counts = np.zeros(len(discordant), dtype=np.int64)
+    for start in range(0, n_permutations, batch_size):
+        size = min(batch_size, n_permutations - start)
+        n10 = rng.binomial(discordant, 0.5, size=(size, len(discordant)))
+        counts += (np.abs(2 * n10 - discordant) >= observed).sum(axis=0)
+    return counts
+
+
+def get_permutation_pvalues(tables, n_permutations=100000, seed=52, max_workers=1, permutations_per_task=100000,
+                            batch_size=10000):
+    """
+    Monte Carlo permutation p-values of the McNemar test for a stack of 2x2 tables laid out as in
+    get_mcnemar_contingency_table. Treatment labels are flipped within discordant pairs; a permutation counts as
+    extreme when its |n10 - n01| is at least the observed one (the corrected chi-square is monotone in it).
+    :param seed: seed of a numpy SeedSequence spawned once per task, so results do not depend on max_workers
+    :param max_workers: processes to spread tasks over (see hbs.parallel.map_tasks)
+    :param permutations_per_task: permutations drawn by one task
+    :param batch_size: permutations drawn together as one array (bounds memory)
+    :return: array of p-values (count + 1) / (n_permutations + 1), one per table
+    """
+    tables = np.asarray(tables).reshape(-1, 2, 2).astype(np.int64)
+    n10, n01 = tables[:, 0, 1], tables[:, 1, 0]
+    discordant, observed = n10 + n01, np.abs(n10 - n01)
+    sizes = [min(permutations_per_task, n_permutations - start)
+             for start in range(0, n_permutations, permutations_per_task)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(seed_sequence, discordant, observed, size, batch_size)
+             for seed_sequence, size in zip(seed_sequences, sizes)]
+    counts = list(map_tasks(_count_extreme, tasks, max_workers=max_workers))
+    return (np.sum(counts, axis=0) + 1) / (n_permutations + 1)
+
+
+def run_permutation_test(df, category='dementia', by='year', n_permutations=100000, seed=52, max_workers=1, **kwargs):
+    """
+    McNemar tests with permutation p-values for every year of a stacked frame of pairs, e.g. the inputs of
+    run_mcnemar_series or several get_mcnemar_test_inputs results concatenated with a year column.
+    Pairs with NULL flags are dropped. kwargs are passed to get_permutation_pvalues.
+    :return: DataFrame of get_mcnemar_stats columns plus pvalue_permutation, one row per value of by
+    """
+    keys, tables = get_mcnemar_contingency_tables(df, category=category, by=by)
+    stats = get_mcnemar_stats(tables)
+    stats.insert(0, by, keys)
+    stats['pvalue_permutation'] = get_permutation_pvalues(tables, n_permutations=n_permutations, seed=seed,
+                                                          max_workers=max_workers, **kwargs)
+    return stats
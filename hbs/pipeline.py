@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from hbs.instrumentation import stage_labels
+from hbs.utils import fetch_mcnemar_grid, get_mcnemar_contingency_tables, get_mcnemar_stats
+
+# row/column labels of each disease category in displayed contingency tables
+category_labels = {'diabetes': 'Diabetes', 'cardio': 'Cardiovascular', 'dementia': 'Dementia'}
+
+
+def get_contingency_table_frame(contingency_table, category):
+    """Label a 2x2 array from get_mcnemar_contingency_table with control rows and treated columns for display."""
+    label = category_labels[category]
+    return pd.DataFrame(
+        contingency_table,
+        index=pd.MultiIndex.from_tuples([('Control Group', label), ('Control Group', 'No ' + label)]),
+        columns=pd.MultiIndex.from_tuples([('Treated Group', label), ('Treated Group', 'No ' + label)])
+    )
+
+
+def run_mcnemar_series(years, categories, arms, engine, max_workers=4, control_sampling='server', seed=52,
+                       cache=None):
+    """
+    Run the McNemar analysis for every year, category and arm.
+    Pairs carrying the flags of all categories are fetched concurrently in one pass (see fetch_mcnemar_grid),
+    concatenated once per arm, and all contingency tables are tested in one batched call.
+    :param arms: 'baseline' and/or 'simulated'
+    :return: dict with
+        'inputs': dict of arm -> pairs of all years, with a year column and the flags of every category
+        'tables': tidy DataFrame of cell counts n11, n10, n01, n00 (control status first) per arm, category and year
+        'stats': tidy DataFrame of get_mcnemar_stats columns per arm, category and year
+    """
+    years, categories, arms = list(years), list(categories), list(arms)
+    grid = [(year, tuple(categories), arm) for arm in arms for year in years]
+    frames = fetch_mcnemar_grid(grid, engine, max_workers=max_workers, control_sampling=control_sampling, seed=seed,
+                                cache=cache)
+
+    frames = {(year, arm): frame for (year, _, arm), frame in zip(grid, frames)}
+    inputs = {}
+    for arm in arms:
+        inputs[arm] = pd.concat([frames[(year, arm)].assign(year=year) for year in years], ignore_index=True)
+        inputs[arm]['year'] = inputs[arm]['year'].astype('category')
+
+    keys, tables = [], []
+    for arm in arms:
+        for category in categories:
+            # the tables of all years come from one pass over the stacked pairs of the arm
+            with stage_labels(arm=arm):
+                found, counts = get_mcnemar_contingency_tables(inputs[arm], category=category, by='year')
+            # years without pairs have no key and keep an empty table
+            arm_tables = np.zeros((len(years), 2, 2), dtype=np.int64)
+            arm_tables[pd.Index(years).get_indexer(found)] = counts
+            keys.extend((arm, category, year) for year in years)
+            tables.append(arm_tables)
+    tables = np.concatenate(tables)
+    keys = pd.DataFrame(keys, columns=['arm', 'category', 'year'])
+
+    counts = pd.DataFrame(tables.reshape(-1, 4), columns=['n11', 'n10', 'n01', 'n00'])
+    stats = get_mcnemar_stats(tables).drop(columns=['n10', 'n01'])
+    return {
+        'inputs': inputs,
+        'tables': pd.concat([keys, counts], axis=1),
+        'stats': pd.concat([keys, stats], axis=1),
+    }
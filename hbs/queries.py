@@ -1,49 +1,91 @@
-#### MySQL queries ####
-
-def get_treated_subclass_query(year, category, baseline=True):
-    flag_names = {
-        'diabetes': 'sp_diabetes_flag',
-        'cardio': 'cardiovascular',
-        'dementia': 'dementia_flag'
-    }
+#### SQL queries ####
+# Queries are written for MySQL. Pass dialect='sqlite' or 'duckdb' to render them for a local
+# file-backed copy of the hbs tables (see hbs.utils.create_local_engine).
+
+# tables read by the queries below, all in schema hbs
+hbs_tables = ['matched_profiles', 'annual_matched_profile_flags', 'annual_simulated_treatment_flags']
+
+# disease category -> flag column in the annual flag tables
+flag_names = {
+    'diabetes': 'sp_diabetes_flag',
+    'cardio': 'cardiovascular',
+    'dementia': 'dementia_flag'
+}
+
+
+def _quote(name, dialect='mysql'):
+    # quote an identifier that is a reserved word, e.g. year
+    return f"`{name}`" if dialect == 'mysql' else f'"{name}"'
+
+
+def _random_order(seed, dialect='mysql'):
+    # MySQL orders by RAND(seed). Other dialects have no seeded RAND, so they order by
+    # a seeded multiplicative hash of profile_id: reproducible, but a different draw than MySQL.
+    if dialect == 'mysql':
+        return f"rand({seed})"
+    return f"((mp.profile_id * 2654435761 + {seed}) % 4294967296)"
+
+
+def _flag_columns(category):
+    # flag columns of a category, a list of categories, or every category when None
+    if category is None:
+        category = list(flag_names)
+    elif isinstance(category, str):
+        category = [category]
+    return [flag_names[c] for c in category]
+
+
+def _select_flags(category, alias, suffix='', sep=', '):
+    # select list of the flag columns of category, renamed with suffix
+    return sep.join(f"{alias}.{flag} as {flag + suffix}" if suffix else f"{alias}.{flag}"
+                    for flag in _flag_columns(category))
+
+
+def _format_years(years):
+    # render a single year or an iterable of years as a SQL list
+    if isinstance(years, int):
+        years = [years]
+    return ', '.join(str(int(year)) for year in years)
+
+
+def get_treated_subclass_query(year, category, baseline=True, order_by_subclass=False, dialect='mysql'):
+    # category may also be a list of categories, or None for all flag columns in one pass.
+    # order_by_subclass=True sorts rows to match the control query, as needed for streaming merges
     table = 'annual_matched_profile_flags' if baseline==True else 'annual_simulated_treatment_flags'
+    treated_flags = _select_flags(category, 'ampf', '_t', sep=',\n            ')
     treated_subclass_query = f"""
         SELECT 
             mp.subclass,
             mp.treated,
             mp.profile_id as profile_id_t, 
-            ampf.{flag_names[category]} as {flag_names[category] + '_t'}
+            {treated_flags}
         FROM hbs.matched_profiles mp
         LEFT JOIN hbs.{table} ampf
             ON mp.profile_id = ampf.profile_id
-            AND ampf.`year`={year}
+            AND ampf.{_quote('year', dialect)}={year}
         WHERE mp.treated = 1 
             AND ampf.death_flag < 2
+        {'ORDER BY mp.subclass' if order_by_subclass else ''}
         ;"""
     return treated_subclass_query
 
 
-def get_control_subclass_query(year, category):
+def get_control_subclass_query(year, category, dialect='mysql'):
     # select one of each control subclass alive in year
     # set seed parameter n of RAND(n) in query to ensure consistent response
-    flag_names = {
-        'diabetes': 'sp_diabetes_flag',
-        'cardio': 'cardiovascular',
-        'dementia': 'dementia_flag'
-    }
     control_subclass_query = f"""
-        select t1.subclass, t1.treated, t1.profile_id as profile_id_c, t1.{flag_names[category]} as {flag_names[category] + '_c'} 
+        select t1.subclass, t1.treated, t1.profile_id as profile_id_c, {_select_flags(category, 't1', '_c')} 
         from (
             select 
                 mp.profile_id, 
                 mp.treated,
                 mp.subclass, 
-                ampf.{flag_names[category]},
-                row_number() over (partition by mp.subclass order by rand(52)) as rownum 
+                {_select_flags(category, 'ampf')},
+                row_number() over (partition by mp.subclass order by {_random_order(52, dialect)}) as rownum 
             from hbs.matched_profiles mp
             left join hbs.annual_matched_profile_flags ampf
                 on mp.profile_id = ampf.profile_id
-                and ampf.`year`={year}
+                and ampf.{_quote('year', dialect)}={year}
             where mp.treated = 0 
                 and ampf.death_flag < 2
             ) t1
@@ -52,3 +94,201 @@ def get_control_subclass_query(year, category):
         ;"""
     return control_subclass_query
 
+
+def get_treated_subclass_years_query(years, category, baseline=True, dialect='mysql'):
+    # same as get_treated_subclass_query for a list or range of years, with a year column
+    table = 'annual_matched_profile_flags' if baseline==True else 'annual_simulated_treatment_flags'
+    treated_flags = _select_flags(category, 'ampf', '_t', sep=',\n            ')
+    treated_subclass_query = f"""
+        SELECT 
+            ampf.{_quote('year', dialect)},
+            mp.subclass,
+            mp.treated,
+            mp.profile_id as profile_id_t, 
+            {treated_flags}
+        FROM hbs.matched_profiles mp
+        LEFT JOIN hbs.{table} ampf
+            ON mp.profile_id = ampf.profile_id
+            AND ampf.{_quote('year', dialect)} in ({_format_years(years)})
+        WHERE mp.treated = 1 
+            AND ampf.death_flag < 2
+        ;"""
+    return treated_subclass_query
+
+
+def get_control_subclass_years_query(years, category, dialect='mysql'):
+    # select one of each control subclass alive in each year
+    control_subclass_query = f"""
+        select t1.{_quote('year', dialect)}, t1.subclass, t1.treated, t1.profile_id as profile_id_c, {_select_flags(category, 't1', '_c')} 
+        from (
+            select 
+                ampf.{_quote('year', dialect)},
+                mp.profile_id, 
+                mp.treated,
+                mp.subclass, 
+                {_select_flags(category, 'ampf')},
+                row_number() over (partition by ampf.{_quote('year', dialect)}, mp.subclass order by {_random_order(52, dialect)}) as rownum 
+            from hbs.matched_profiles mp
+            left join hbs.annual_matched_profile_flags ampf
+                on mp.profile_id = ampf.profile_id
+                and ampf.{_quote('year', dialect)} in ({_format_years(years)})
+            where mp.treated = 0 
+                and ampf.death_flag < 2
+            ) t1
+        where t1.rownum=1
+        order by t1.{_quote('year', dialect)}, t1.subclass
+        ;"""
+    return control_subclass_query
+
+
+def get_control_candidates_query(years, category, dialect='mysql'):
+    # all controls alive in each year; one per subclass is picked client-side
+    control_flags = _select_flags(category, 'ampf', '_c', sep=',\n            ')
+    control_candidates_query = f"""
+        select 
+            ampf.{_quote('year', dialect)},
+            mp.subclass, 
+            mp.treated,
+            mp.profile_id as profile_id_c, 
+            {control_flags}
+        from hbs.matched_profiles mp
+        left join hbs.annual_matched_profile_flags ampf
+            on mp.profile_id = ampf.profile_id
+            and ampf.{_quote('year', dialect)} in ({_format_years(years)})
+        where mp.treated = 0 
+            and ampf.death_flag < 2
+        ;"""
+    return control_candidates_query
+
+
+def get_subclass_counts_query(years, category, baseline=True, dialect='mysql'):
+    # count alive treated and control profiles of each subclass by disease flag, using every control.
+    # treated flags come from the arm's table and control flags from the baseline table; no window or sort is needed.
+    flag = flag_names[category]
+    table = 'annual_matched_profile_flags' if baseline==True else 'annual_simulated_treatment_flags'
+    subclass_counts_query = f"""
+        select ampf.{_quote('year', dialect)}, mp.subclass, mp.treated, ampf.{flag} as flag, count(*) as n
+        from hbs.matched_profiles mp
+        left join hbs.{table} ampf
+            on mp.profile_id = ampf.profile_id
+            and ampf.{_quote('year', dialect)} in ({_format_years(years)})
+        where mp.treated = 1
+            and ampf.death_flag < 2
+        group by ampf.{_quote('year', dialect)}, mp.subclass, mp.treated, ampf.{flag}
+        union all
+        select ampf.{_quote('year', dialect)}, mp.subclass, mp.treated, ampf.{flag} as flag, count(*) as n
+        from hbs.matched_profiles mp
+        left join hbs.annual_matched_profile_flags ampf
+            on mp.profile_id = ampf.profile_id
+            and ampf.{_quote('year', dialect)} in ({_format_years(years)})
+        where mp.treated = 0
+            and ampf.death_flag < 2
+        group by ampf.{_quote('year', dialect)}, mp.subclass, mp.treated, ampf.{flag}
+        ;"""
+    return subclass_counts_query
+
+
+def get_control_pairs_query(years, category, seed=52, dialect='mysql'):
+    # controls picked by hbs.utils.materialize_control_pairs, joined to their flags by (profile_id, year).
+    # rows come in (year, subclass) order, served by the pairing table's index, so merge_pairs needs no hash join
+    control_flags = _select_flags(category, 'ampf', '_c', sep=',\n            ')
+    control_pairs_query = f"""
+        select 
+            p.{_quote('year', dialect)},
+            p.subclass, 
+            0 as treated,
+            p.profile_id_c, 
+            {control_flags}
+        from hbs.matched_pairs_by_year p
+        inner join hbs.annual_matched_profile_flags ampf
+            on ampf.profile_id = p.profile_id_c
+            and ampf.{_quote('year', dialect)} = p.{_quote('year', dialect)}
+        where p.seed = {int(seed)}
+            and p.{_quote('year', dialect)} in ({_format_years(years)})
+        order by p.{_quote('year', dialect)}, p.subclass
+        ;"""
+    return control_pairs_query
+
+
+def get_create_index_query(table, columns, dialect='mysql'):
+    # composite index on a table of schema hbs, named after its columns
+    name = f"ix_{table}_{'_'.join(columns)}"
+    columns = ', '.join(_quote(column, dialect) for column in columns)
+    if dialect == 'sqlite':
+        # sqlite puts the schema on the index name, not the table
+        return f"CREATE INDEX hbs.{name} ON {table} ({columns});"
+    return f"CREATE INDEX {name} ON hbs.{table} ({columns});"
+
+
+def get_mcnemar_contingency_query(years, category, baseline=True, dialect='mysql'):
+    # pair treated subjects with one random control per subclass on the server
+    # and return only the count of pairs in each cell of the 2x2 table per year.
+    # NULL flags are kept as their own groups so the caller decides how to treat them.
+    flag = flag_names[category]
+    table = 'annual_matched_profile_flags' if baseline==True else 'annual_simulated_treatment_flags'
+    contingency_query = f"""
+        select t.{_quote('year', dialect)}, c.flag_c, t.flag_t, count(*) as n
+        from (
+            select
+                ampf.{_quote('year', dialect)},
+                mp.subclass,
+                ampf.{flag} as flag_t
+            from hbs.matched_profiles mp
+            left join hbs.{table} ampf
+                on mp.profile_id = ampf.profile_id
+                and ampf.{_quote('year', dialect)} in ({_format_years(years)})
+            where mp.treated = 1
+                and ampf.death_flag < 2
+            ) t
+        inner join (
+            select t1.{_quote('year', dialect)}, t1.subclass, t1.{flag} as flag_c
+            from (
+                select
+                    ampf.{_quote('year', dialect)},
+                    mp.subclass,
+                    ampf.{flag},
+                    row_number() over (partition by ampf.{_quote('year', dialect)}, mp.subclass order by {_random_order(52, dialect)}) as rownum
+                from hbs.matched_profiles mp
+                left join hbs.annual_matched_profile_flags ampf
+                    on mp.profile_id = ampf.profile_id
+                    and ampf.{_quote('year', dialect)} in ({_format_years(years)})
+                where mp.treated = 0
+                    and ampf.death_flag < 2
+                ) t1
+            where t1.rownum=1
+            ) c
+            on t.subclass = c.subclass
+            and t.{_quote('year', dialect)} = c.{_quote('year', dialect)}
+        group by t.{_quote('year', dialect)}, c.flag_c, t.flag_t
+        order by t.{_quote('year', dialect)}, c.flag_c, t.flag_t
+        ;"""
+    return contingency_query
+
+
+def get_partition_fingerprint_query(years, table, dialect='mysql'):
+    # cheap per-year aggregates of an annual flag table, used to detect which years changed.
+    # each column is summed both plainly and weighted by profile_id, so moved or edited rows change the result.
+    flag_sums = ',\n            '.join(
+        f"count({flag}) as {flag}_count, sum({flag}) as {flag}_sum, sum(profile_id * ({flag} + 1)) as {flag}_checksum"
+        for flag in _flag_columns(None))
+    fingerprint_query = f"""
+        SELECT 
+            {_quote('year', dialect)},
+            count(*) as n_rows,
+            sum(profile_id) as profile_id_sum,
+            sum(profile_id * (death_flag + 1)) as death_flag_checksum,
+            {flag_sums}
+        FROM hbs.{table}
+        WHERE {_quote('year', dialect)} in ({_format_years(years)})
+        GROUP BY {_quote('year', dialect)}
+        ;"""
+    return fingerprint_query
+
+
+def get_matched_profiles_fingerprint_query():
+    # aggregates of the matching itself; a change here invalidates every year
+    return """
+        SELECT count(*) as n_rows, sum(profile_id * subclass) as subclass_checksum, 
+            sum(profile_id * treated) as treated_checksum
+        FROM hbs.matched_profiles
+        ;"""
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+from hbs.parallel import map_tasks
+from hbs.queries import flag_names, get_treated_subclass_years_query, get_control_candidates_query
+from hbs.utils import _read_sql, get_candidate_groups, get_control_picks, get_mcnemar_stats
+
+# data of each (arm, category) cell, set in worker processes by _init_worker
+_worker_data = None
+
+
+def prepare_resampling_data(treated, candidates, category):
+    """
+    Index treated rows and alive control candidates for repeated control draws.
+    :param treated: result of get_treated_subclass_years_query
+    :param candidates: result of get_control_candidates_query
+    :return: dict of arrays describing the (year, subclass) groups of candidates and the treated rows matched to them
+    """
+    flag = flag_names[category]
+    order = np.lexsort((candidates['profile_id_c'].to_numpy(),
+                        candidates['subclass'].to_numpy(),
+                        candidates['year'].to_numpy()))
+    candidates = candidates.iloc[order]
+    cand_year = candidates['year'].to_numpy(dtype=np.int64)
+    cand_subclass = candidates['subclass'].to_numpy(dtype=np.int64)
+    # NULL control flags are kept as -1 so a draw that picks them drops the pair, as in the inner merge path
+    cand_flag = candidates[flag + '_c'].fillna(-1).to_numpy(dtype=np.int64)
+    starts, sizes = get_candidate_groups(cand_year, cand_subclass)
+    group_year = cand_year[starts]
+    group_subclass = cand_subclass[starts]
+
+    # match treated rows to candidate groups (inner join on year and subclass), dropping NULL treated flags
+    treated = treated[treated[flag + '_t'].notna()]
+    group_index = pd.MultiIndex.from_arrays([group_year, group_subclass])
+    treated_group = group_index.get_indexer(pd.MultiIndex.from_arrays([
+        treated['year'].to_numpy(dtype=np.int64), treated['subclass'].to_numpy(dtype=np.int64)]))
+    matched = treated_group >= 0
+    years = np.unique(group_year)
+    return {
+        'years': years,
+        'starts': starts,
+        'sizes': sizes,
+        'group_year': group_year,
+        'group_subclass': group_subclass,
+        'group_year_index': np.searchsorted(years, group_year),
+        'cand_flag': cand_flag,
+        'treated_group': treated_group[matched],
+        'treated_flag': treated[flag + '_t'].to_numpy(dtype=np.int64)[matched],
+    }
+
+
+def _bootstrap_weights(data, seeds):
+    # per draw, resample the matched subclasses of each year with replacement
+    matched_groups = np.unique(data['treated_group'])
+    year_index = data['group_year_index'][matched_groups]
+    offsets = np.searchsorted(year_index, np.arange(len(data['years'])))
+    counts = np.bincount(year_index, minlength=len(data['years']))
+    weights = np.zeros((len(seeds), len(data['starts'])))
+    for d, seed in enumerate(seeds):
+        u = np.random.default_rng([int(seed), 1]).random(len(matched_groups))
+        resampled = matched_groups[offsets[year_index] + (u * counts[year_index]).astype(np.int64)]
+        weights[d] = np.bincount(resampled, minlength=len(data['starts']))
+    return weights
+
+
+def draw_contingency_tables(data, seeds, bootstrap=False):
+    """
+    Contingency tables for one control draw per seed. A draw with seed s picks the same controls as select_controls(seed=s).
+    :param data: result of prepare_resampling_data
+    :param seeds: array of draw seeds
+    :param bootstrap: also resample subclasses with replacement within each year
+    :return: array of shape (len(seeds), len(data['years']), 2, 2)
+    """
+    seeds = np.asarray(seeds, dtype=np.int64)
+    n_draws, n_years = len(seeds), len(data['years'])
+    picks = get_control_picks(seeds[:, np.newaxis], data['group_year'], data['group_subclass'], data['starts'],
+                              data['sizes'])
+    flag_c = data['cand_flag'][picks][:, data['treated_group']]
+    cells = 2 * flag_c + data['treated_flag']
+    if bootstrap:
+        weights = _bootstrap_weights(data, seeds)[:, data['treated_group']]
+    else:
+        weights = np.ones(cells.shape)
+    weights[flag_c < 0] = 0
+    year_index = data['group_year_index'][data['treated_group']]
+    index = (np.arange(n_draws)[:, np.newaxis] * n_years + year_index) * 4 + np.clip(cells, 0, 3)
+    counts = np.bincount(index.ravel(), weights=weights.ravel(), minlength=n_draws * n_years * 4)
+    return counts.astype(np.int64).reshape(n_draws, n_years, 4)[:, :, ::-1].reshape(n_draws, n_years, 2, 2)
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _run_chunk(key, seeds, bootstrap):
+    return key, seeds, draw_contingency_tables(_worker_data[key], seeds, bootstrap=bootstrap)
+
+
+def fetch_resampling_data(years, categories, arms, engine, cache=None):
+    """
+    Fetch treated rows and all alive control candidates once, with the flags of every category in the same pass.
+    Control candidates are shared between arms.
+    :return: dict of (arm, category) -> prepare_resampling_data result
+    """
+    categories = list(categories)
+    control_candidates_query = get_control_candidates_query(years=years, category=categories,
+                                                            dialect=engine.dialect.name)
+    candidates = _read_sql(control_candidates_query, engine, cache)
+    data = {}
+    for arm in arms:
+        treated_subclass_query = get_treated_subclass_years_query(years=years, category=categories,
+                                                                  baseline=arm == 'baseline',
+                                                                  dialect=engine.dialect.name)
+        treated = _read_sql(treated_subclass_query, engine, cache)
+        for category in categories:
+            data[(arm, category)] = prepare_resampling_data(treated, candidates, category)
+    return data
+
+
+def run_control_resampling(data, n_draws=1000, seed=52, bootstrap=False, max_workers=None, draws_per_task=8):
+    """
+    Repeat the random control selection n_draws times per year, category and arm and test every draw.
+    :param data: result of fetch_resampling_data; no queries are run here
+    :param seed: seed of the first draw; draw d uses seed + d, so draw 0 reproduces select_controls(seed=seed)
+    :param bootstrap: also resample subclasses with replacement in every draw
+    :param max_workers: processes to spread draws over (see hbs.parallel.map_tasks)
+    :param draws_per_task: draws computed together as one stacked array (bounds memory per task)
+    :return: tidy DataFrame of per-draw statistics and DataFrame summarizing their distribution
+    """
+    seeds = seed + np.arange(n_draws)
+    tasks = [(key, seeds[i:i + draws_per_task], bootstrap)
+             for key in data for i in range(0, n_draws, draws_per_task)]
+    results = list(map_tasks(_run_chunk, tasks, max_workers=max_workers, initializer=_init_worker, initargs=(data,)))
+
+    frames = []
+    for (arm, category), draw_seeds, tables in results:
+        years = data[(arm, category)]['years']
+        stats = get_mcnemar_stats(tables.reshape(-1, 2, 2))
+        stats.insert(0, 'year', np.tile(years, len(draw_seeds)))
+        stats.insert(0, 'seed', np.repeat(draw_seeds, len(years)))
+        stats.insert(0, 'draw', np.repeat(draw_seeds - seed, len(years)))
+        stats.insert(0, 'category', category)
+        stats.insert(0, 'arm', arm)
+        frames.append(stats)
+    draws = pd.concat(frames, ignore_index=True).sort_values(['arm', 'category', 'draw', 'year'], ignore_index=True)
+    return draws, summarize_resampling(draws)
+
+
+def summarize_resampling(draws, alpha=0.05):
+    """Summarize the distribution of statistics and p-values over draws per arm, category and year."""
+    grouped = draws.groupby(['arm', 'category', 'year'])
+    summary = grouped['statistic'].describe(percentiles=[0.025, 0.5, 0.975]).add_prefix('statistic_')
+    pvalues = grouped['pvalue'].describe(percentiles=[0.025, 0.5, 0.975]).drop(columns='count').add_prefix('pvalue_')
+    rejected = grouped['pvalue'].apply(lambda p: (p < alpha).mean()).rename('share_rejected')
+    return pd.concat([summary, pvalues, rejected], axis=1).reset_index()
@@ -0,0 +1,198 @@
+# Contingency tables and test statistics computed from arrays of pairs or counts.
+# Importable without sqlalchemy or statsmodels; scipy is imported on first use.
+
+import numpy as np
+import pandas as pd
+from hbs.instrumentation import stage
+from hbs.queries import flag_names
+
+
+def _get_cell_index(df, category, na='drop'):
+    """
+    Encode each pair as cell index 2*flag_c + flag_t (00=0, 01=1, 10=2, 11=3).
+    :param na: 'drop' to skip pairs with a NULL flag on either side, 'raise' to reject them
+    :return: int array of cell indices and boolean mask of the rows kept
+    """
+    if na not in ('drop', 'raise'):
+        raise ValueError(f"na must be 'drop' or 'raise', got {na!r}")
+    flag = flag_names[category]
+    flag_c = df[flag + '_c']
+    flag_t = df[flag + '_t']
+    keep = (flag_c.notna() & flag_t.notna()).to_numpy()
+    if na == 'raise' and not keep.all():
+        raise ValueError(f"{(~keep).sum()} pairs have NULL {flag} flags")
+    flag_c = flag_c[keep].to_numpy(dtype=np.int64)
+    flag_t = flag_t[keep].to_numpy(dtype=np.int64)
+    if ((flag_c | flag_t) & ~1).any():
+        raise ValueError(f"{flag} flags must be 0 or 1")
+    return 2 * flag_c + flag_t, keep
+
+
+def get_mcnemar_contingency_table(df, category='dementia', na='drop'):
+    """Return 2x2 array of counts for each combination of treated + matched control disease status. Rows of array represent control status ordered by status=1, status=0. Columns represent status of treated ordered by status=1, status=0. Pairs with a NULL flag are dropped unless na='raise'."""
+    with stage('contingency', category=category) as info:
+        cells, _ = _get_cell_index(df, category, na=na)
+        # counts come out ordered 00, 01, 10, 11; reverse to put status=1 first
+        counts = np.bincount(cells, minlength=4)
+        if info is not None:
+            info['rows'] = len(df)
+        return counts[::-1].reshape(2, 2)
+
+
+def get_mcnemar_contingency_tables(df, category='dementia', by='year', na='drop'):
+    """
+    Batched form of get_mcnemar_contingency_table for a stacked frame of pairs.
+    :param by: column identifying each table, e.g. 'year'
+    :return: sorted array of keys and an array of shape (len(keys), 2, 2)
+    """
+    with stage('contingency', category=category) as info:
+        cells, keep = _get_cell_index(df, category, na=na)
+        keys, group = np.unique(df[by].to_numpy()[keep], return_inverse=True)
+        counts = np.bincount(4 * group + cells, minlength=4 * len(keys))
+        if info is not None:
+            info['rows'] = len(df)
+        return keys, counts.reshape(-1, 4)[:, ::-1].reshape(-1, 2, 2)
+
+
+def get_contingency_tables_from_counts(counts, na='drop'):
+    """
+    Convert the result of get_mcnemar_contingency_counts into contingency arrays laid out as in get_mcnemar_contingency_table.
+    :param na: 'drop' to skip cells with a NULL flag, 'raise' to reject them
+    :return: sorted array of years and an array of shape (len(years), 2, 2)
+    """
+    if na not in ('drop', 'raise'):
+        raise ValueError(f"na must be 'drop' or 'raise', got {na!r}")
+    keep = (counts['flag_c'].notna() & counts['flag_t'].notna()).to_numpy()
+    if na == 'raise' and not keep.all():
+        raise ValueError(f"{int(counts.loc[~keep, 'n'].sum())} pairs have NULL flags")
+    counts = counts[keep]
+    flag_c = counts['flag_c'].to_numpy(dtype=np.int64)
+    flag_t = counts['flag_t'].to_numpy(dtype=np.int64)
+    if ((flag_c | flag_t) & ~1).any():
+        raise ValueError("flags must be 0 or 1")
+    cells = 2 * flag_c + flag_t
+    years, group = np.unique(counts['year'].to_numpy(), return_inverse=True)
+    tables = np.bincount(4 * group + cells, weights=counts['n'].to_numpy(), minlength=4 * len(years))
+    return years, tables.astype(np.int64).reshape(-1, 4)[:, ::-1].reshape(-1, 2, 2)
+
+
+def get_mantel_haenszel_stats(counts, na='drop'):
+    """
+    Mantel-Haenszel analysis per year with every subclass as a stratum, from the result of get_subclass_counts.
+    Each stratum is the 2x2 table of treated/control by diseased/healthy; strata without both a treated and a
+    control profile carry no information and are dropped. With one control per subclass the uncorrected statistic
+    equals the uncorrected McNemar statistic of the pairs.
+    :param na: 'drop' to skip profiles with a NULL flag, 'raise' to reject them
+    :return: DataFrame with one row per year: n_strata, odds_ratio with its 95% Robins-Breslow-Greenland interval,
+        and the Cochran-Mantel-Haenszel chi-square with (statistic, pvalue) and without continuity correction
+    """
+    from scipy.stats import chi2, norm
+    if na not in ('drop', 'raise'):
+        raise ValueError(f"na must be 'drop' or 'raise', got {na!r}")
+    keep = counts['flag'].notna().to_numpy()
+    if na == 'raise' and not keep.all():
+        raise ValueError(f"{int(counts.loc[~keep, 'n'].sum())} profiles have NULL flags")
+    counts = counts[keep]
+    flag = counts['flag'].to_numpy(dtype=np.int64)
+    treated = counts['treated'].to_numpy(dtype=np.int64)
+    if ((flag | treated) & ~1).any():
+        raise ValueError("flags and treated must be 0 or 1")
+    # stratum cells ordered a = treated diseased, b = treated healthy, c = control diseased, d = control healthy
+    cells = 2 * (1 - treated) + (1 - flag)
+    strata, stratum = np.unique(counts[['year', 'subclass']].to_numpy(dtype=np.int64), axis=0, return_inverse=True)
+    stratum = stratum.ravel()
+    a, b, c, d = np.bincount(4 * stratum + cells, weights=counts['n'].to_numpy(dtype=np.float64),
+                             minlength=4 * len(strata)).reshape(-1, 4).T
+    n = a + b + c + d
+    informative = (a + b > 0) & (c + d > 0)
+    years, year = np.unique(strata[informative, 0], return_inverse=True)
+    a, b, c, d, n = (x[informative] for x in (a, b, c, d, n))
+
+    def total(x):
+        return np.bincount(year, weights=x, minlength=len(years))
+
+    expected = (a + b) * (a + c) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = np.where(n > 1, (a + b) * (c + d) * (a + c) * (b + d) / (n ** 2 * (n - 1)), 0.0)
+        deviation, variance = total(a - expected), total(variance)
+        statistic = np.maximum(np.abs(deviation) - 0.5, 0) ** 2 / variance
+        statistic_uncorrected = deviation ** 2 / variance
+        r, s = a * d / n, b * c / n
+        p, q = (a + d) / n, (b + c) / n
+        sum_r, sum_s = total(r), total(s)
+        odds_ratio = sum_r / sum_s
+        log_se = np.sqrt(total(p * r) / (2 * sum_r ** 2) + total(p * s + q * r) / (2 * sum_r * sum_s)
+                         + total(q * s) / (2 * sum_s ** 2))
+    z = norm.ppf(0.975)
+    return pd.DataFrame({
+        'year': years,
+        'n_strata': np.bincount(year, minlength=len(years)),
+        'odds_ratio': odds_ratio,
+        'odds_ratio_lower': odds_ratio * np.exp(-z * log_se),
+        'odds_ratio_upper': odds_ratio * np.exp(z * log_se),
+        'statistic': statistic,
+        'pvalue': chi2.sf(statistic, 1),
+        'statistic_uncorrected': statistic_uncorrected,
+        'pvalue_uncorrected': chi2.sf(statistic_uncorrected, 1),
+    })
+
+
+def get_mcnemar_stats(tables, check=False):
+    """
+    Vectorized McNemar tests for a stack of 2x2 tables laid out as in get_mcnemar_contingency_table.
+    statistic/pvalue match statsmodels mcnemar(exact=False, correction=True); the uncorrected chi-square and the
+    exact binomial p-value (preferable when the discordant count is small, e.g. below 25) are also returned.
+    :param tables: array of shape (N, 2, 2) or a single (2, 2) table
+    :param check: compare every row with statsmodels and raise AssertionError on a mismatch
+    :return: DataFrame with one row per table
+    """
+    with stage('mcnemar') as info:
+        stats = _get_mcnemar_stats(tables)
+        if info is not None:
+            info['rows'] = len(stats)
+    if check:
+        _check_mcnemar_stats(np.asarray(tables).reshape(-1, 2, 2), stats)
+    return stats
+
+
+def _get_mcnemar_stats(tables):
+    from scipy.stats import binom, chi2
+    tables = np.asarray(tables)
+    if tables.ndim == 2:
+        tables = tables[np.newaxis]
+    # discordant pairs: control with disease + treated without, and the reverse
+    n10 = tables[:, 0, 1].astype(np.float64)
+    n01 = tables[:, 1, 0].astype(np.float64)
+    discordant = n10 + n01
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistic = (np.abs(n10 - n01) - 1) ** 2 / discordant
+        statistic_uncorrected = (n10 - n01) ** 2 / discordant
+    stats = pd.DataFrame({
+        'n10': n10.astype(np.int64),
+        'n01': n01.astype(np.int64),
+        'statistic': statistic,
+        'pvalue': chi2.sf(statistic, 1),
+        'statistic_uncorrected': statistic_uncorrected,
+        'pvalue_uncorrected': chi2.sf(statistic_uncorrected, 1),
+        'pvalue_exact': np.minimum(2 * binom.cdf(np.minimum(n10, n01), discordant, 0.5), 1.0),
+    })
+    return stats
+
+
+def _check_mcnemar_stats(tables, stats):
+    # compare get_mcnemar_stats with statsmodels, one table at a time
+    from statsmodels.stats.contingency_tables import mcnemar
+    for i, table in enumerate(tables):
+        # tables without discordant pairs divide by zero in statsmodels as in _get_mcnemar_stats
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = {
+                ('statistic', 'pvalue'): mcnemar(table, exact=False, correction=True),
+                ('statistic_uncorrected', 'pvalue_uncorrected'): mcnemar(table, exact=False, correction=False),
+                (None, 'pvalue_exact'): mcnemar(table, exact=True),
+            }
+        for (statistic_col, pvalue_col), result in expected.items():
+            if statistic_col is not None:
+                np.testing.assert_allclose(stats[statistic_col].iloc[i], result.statistic, rtol=1e-10,
+                                           err_msg=f"table {i}: {statistic_col}")
+            np.testing.assert_allclose(stats[pvalue_col].iloc[i], result.pvalue, rtol=1e-8, atol=1e-300,
+                                       err_msg=f"table {i}: {pvalue_col}")
@@ -0,0 +1,184 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from hbs.queries import flag_names, _quote
+from hbs.utils import get_candidate_groups, get_control_picks
+
+# treated flag table of each arm; controls always come from the baseline table
+arm_tables = {'baseline': 'annual_matched_profile_flags', 'simulated': 'annual_simulated_treatment_flags'}
+
+
+class FlagStore:
+    """
+    Dense in-memory copy of the hbs flag tables for longitudinal analysis.
+    Profiles are ordered by (subclass, profile_id). For every arm, flags[arm] is an int8 array of
+    shape (profiles, years, categories) and death_flag[arm] an int8 array of shape (profiles, years).
+    Missing rows and NULL values are stored as -1; a profile counts as alive when 0 <= death_flag < 2.
+    """
+
+    categories = list(flag_names)
+
+    def __init__(self, profile_id, subclass, treated, years, flags, death_flag):
+        self.profile_id = profile_id
+        self.subclass = subclass
+        self.treated = treated
+        self.years = np.asarray(years)
+        self.flags = flags
+        self.death_flag = death_flag
+
+    @classmethod
+    def from_tables(cls, matched_profiles, flag_tables, years=None):
+        """
+        Build a store from DataFrames shaped like the hbs tables.
+        :param matched_profiles: profile_id, subclass, treated
+        :param flag_tables: dict of arm -> annual flag table (profile_id, year, death_flag and the flag columns)
+        :param years: years to keep (defaults to every year in the baseline table)
+        """
+        order = np.lexsort((matched_profiles['profile_id'].to_numpy(), matched_profiles['subclass'].to_numpy()))
+        matched_profiles = matched_profiles.iloc[order]
+        store = cls._empty(matched_profiles, years if years is not None else
+                           np.unique(flag_tables['baseline']['year'].to_numpy()), list(flag_tables))
+        for arm, table in flag_tables.items():
+            store._fill(arm, table)
+        return store
+
+    @classmethod
+    def from_engine(cls, engine, years, arms=('baseline', 'simulated')):
+        """Load the store from the database one year of each flag table at a time, so memory stays bounded by a year of rows with any driver."""
+        matched_profiles = pd.read_sql("SELECT profile_id, subclass, treated FROM hbs.matched_profiles;", con=engine)
+        order = np.lexsort((matched_profiles['profile_id'].to_numpy(), matched_profiles['subclass'].to_numpy()))
+        store = cls._empty(matched_profiles.iloc[order], years, arms)
+        columns = ', '.join(flag_names[category] for category in cls.categories)
+        year = _quote('year', engine.dialect.name)
+        for arm in arms:
+            for y in store.years:
+                query = f"""
+                    SELECT profile_id, {year}, death_flag, {columns}
+                    FROM hbs.{arm_tables[arm]}
+                    WHERE {year} = {int(y)}
+                    ;"""
+                store._fill(arm, pd.read_sql(query, con=engine))
+        return store
+
+    @classmethod
+    def _empty(cls, matched_profiles, years, arms):
+        years = np.sort(np.asarray(list(years), dtype=np.int64))
+        n_profiles = len(matched_profiles)
+        return cls(
+            profile_id=matched_profiles['profile_id'].to_numpy(dtype=np.int64),
+            subclass=matched_profiles['subclass'].to_numpy(dtype=np.int64),
+            treated=matched_profiles['treated'].to_numpy(dtype=np.int8),
+            years=years,
+            flags={arm: np.full((n_profiles, len(years), len(cls.categories)), -1, dtype=np.int8) for arm in arms},
+            death_flag={arm: np.full((n_profiles, len(years)), -1, dtype=np.int8) for arm in arms},
+        )
+
+    def _fill(self, arm, table):
+        # scatter rows of an annual flag table into the dense arrays, skipping unknown profiles and years
+        profile_order = np.argsort(self.profile_id)
+        profile_id = table['profile_id'].to_numpy(dtype=np.int64)
+        position = np.searchsorted(self.profile_id, profile_id, sorter=profile_order).clip(0, len(profile_order) - 1)
+        row = profile_order[position]
+        year = table['year'].to_numpy(dtype=np.int64)
+        col = np.searchsorted(self.years, year).clip(0, len(self.years) - 1)
+        known = (self.profile_id[row] == profile_id) & (self.years[col] == year)
+        row, col, table = row[known], col[known], table[known]
+        self.death_flag[arm][row, col] = table['death_flag'].fillna(-1).to_numpy(dtype=np.int8)
+        for k, category in enumerate(self.categories):
+            self.flags[arm][row, col, k] = table[flag_names[category]].fillna(-1).to_numpy(dtype=np.int8)
+
+    def alive(self, arm, year, max_death_flag=1):
+        """Boolean mask of profiles with a flag row in year and death_flag <= max_death_flag."""
+        death_flag = self.death_flag[arm][:, self._year_index(year)]
+        return (death_flag >= 0) & (death_flag <= max_death_flag)
+
+    def _year_index(self, year):
+        index = np.searchsorted(self.years, year)
+        if index >= len(self.years) or self.years[index] != year:
+            raise KeyError(f"year {year} is not in the store")
+        return index
+
+    def pair_indices(self, year, arm='baseline', seed=52, max_death_flag=1, min_controls=1):
+        """
+        Pair every alive treated profile with one alive control of its subclass, picked as in
+        hbs.utils.select_controls(seed=seed).
+        :param min_controls: drop subclasses with fewer alive controls than this
+        :return: arrays of treated and control profile positions
+        """
+        control = np.flatnonzero((self.treated == 0) & self.alive('baseline', year, max_death_flag))
+        treated = np.flatnonzero((self.treated == 1) & self.alive(arm, year, max_death_flag))
+        control_subclass = self.subclass[control]
+        starts, sizes = get_candidate_groups(year, control_subclass)
+        keep = sizes >= min_controls
+        starts, sizes = starts[keep], sizes[keep]
+        group_subclass = control_subclass[starts]
+        picks = control[get_control_picks(seed, year, group_subclass, starts, sizes)]
+        if len(group_subclass) == 0:
+            return treated[:0], picks
+        # inner join of treated profiles to the picked controls on subclass
+        position = np.searchsorted(group_subclass, self.subclass[treated]).clip(0, len(group_subclass) - 1)
+        matched = group_subclass[position] == self.subclass[treated]
+        return treated[matched], picks[position[matched]]
+
+    def pairs(self, year, category, arm='baseline', seed=52, **kwargs):
+        """Matched pairs of a year as a DataFrame with the columns of get_mcnemar_test_inputs plus year."""
+        treated, control = self.pair_indices(year, arm=arm, seed=seed, **kwargs)
+        flag, k, y = flag_names[category], self.categories.index(category), self._year_index(year)
+        flags_t = self.flags[arm][treated, y, k]
+        flags_c = self.flags['baseline'][control, y, k]
+        return pd.DataFrame({
+            'year': year,
+            'subclass': self.subclass[treated],
+            'profile_id_t': self.profile_id[treated],
+            flag + '_t': pd.arrays.IntegerArray(flags_t, flags_t < 0),
+            'profile_id_c': self.profile_id[control],
+            flag + '_c': pd.arrays.IntegerArray(flags_c, flags_c < 0),
+        })
+
+    def contingency_tables(self, years, category, arm='baseline', seed=52, **kwargs):
+        """Contingency tables laid out as in get_mcnemar_contingency_table, shape (len(years), 2, 2). Pairs with NULL flags are dropped."""
+        k = self.categories.index(category)
+        tables = np.zeros((len(years), 2, 2), dtype=np.int64)
+        for i, year in enumerate(years):
+            treated, control = self.pair_indices(year, arm=arm, seed=seed, **kwargs)
+            y = self._year_index(year)
+            flags_t = self.flags[arm][treated, y, k].astype(np.int64)
+            flags_c = self.flags['baseline'][control, y, k].astype(np.int64)
+            known = (flags_t >= 0) & (flags_c >= 0)
+            counts = np.bincount(2 * flags_c[known] + flags_t[known], minlength=4)
+            tables[i] = counts[::-1].reshape(2, 2)
+        return tables
+
+    def save(self, path):
+        """Save the store as a directory of .npy files that load() can memory-map."""
+        os.makedirs(path, exist_ok=True)
+        arrays = {'profile_id': self.profile_id, 'subclass': self.subclass, 'treated': self.treated,
+                  'years': self.years}
+        for arm in self.flags:
+            arrays[f'flags_{arm}'] = self.flags[arm]
+            arrays[f'death_flag_{arm}'] = self.death_flag[arm]
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        with open(os.path.join(path, 'store.json'), 'w') as f:
+            json.dump({'arms': list(self.flags), 'categories': self.categories}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Open a saved store; with mmap_mode='r' the arrays are memory-mapped instead of read."""
+        with open(os.path.join(path, 'store.json')) as f:
+            meta = json.load(f)
+        if meta['categories'] != cls.categories:
+            raise ValueError(f"store categories {meta['categories']} do not match {cls.categories}")
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+        return cls(
+            profile_id=load_array('profile_id'),
+            subclass=load_array('subclass'),
+            treated=load_array('treated'),
+            years=load_array('years'),
+            flags={arm: load_array(f'flags_{arm}') for arm in meta['arms']},
+            death_flag={arm: load_array(f'death_flag_{arm}') for arm in meta['arms']},
+        )
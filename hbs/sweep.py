@@ -0,0 +1,70 @@
+import itertools
+import numpy as np
+import pandas as pd
+from hbs.parallel import map_tasks
+from hbs.stats import get_mcnemar_stats
+from hbs.store import FlagStore
+
+# store of the worker processes, set by _init_worker
+_worker_store = None
+
+
+def _init_worker(store):
+    # a path is opened memory-mapped so workers share the saved arrays instead of receiving copies
+    global _worker_store
+    _worker_store = FlagStore.load(store) if isinstance(store, str) else store
+
+
+def _run_rule(arm, seed, max_death_flag, min_controls, years, categories):
+    # contingency tables of every (year, category) under one inclusion rule; pairs are drawn once per year
+    store = _worker_store
+    k = [store.categories.index(category) for category in categories]
+    tables = np.zeros((len(years), len(categories), 2, 2), dtype=np.int64)
+    for i, year in enumerate(years):
+        treated, control = store.pair_indices(year, arm=arm, seed=seed, max_death_flag=max_death_flag,
+                                              min_controls=min_controls)
+        y = store._year_index(year)
+        flags_t = store.flags[arm][treated, y][:, k].astype(np.int64)
+        flags_c = store.flags['baseline'][control, y][:, k].astype(np.int64)
+        # pairs with a NULL flag are dropped per category, as in get_mcnemar_contingency_table
+        known = (flags_t >= 0) & (flags_c >= 0)
+        cells = np.where(known, 2 * flags_c + flags_t, 4) + 5 * np.arange(len(categories))
+        counts = np.bincount(cells.ravel(), minlength=5 * len(categories)).reshape(-1, 5)[:, :4]
+        tables[i] = counts[:, ::-1].reshape(-1, 2, 2)
+    return tables
+
+
+def run_sensitivity_sweep(store, years=None, categories=('dementia',), arms=('baseline',), seeds=(52,),
+                          max_death_flags=(1,), min_controls=(1,), year_windows=None, max_workers=1):
+    """
+    Evaluate McNemar tests over a grid of inclusion rules on a FlagStore, without querying the database.
+    Each rule is a combination of arm, seed, max_death_flag (profiles count as alive while death_flag <= it; the
+    queries use 1) and min_controls (subclasses with fewer alive controls are dropped). Pairs are drawn once per
+    rule and year and tested for every category in one batched get_mcnemar_stats call.
+    :param store: FlagStore, or the path of a saved one (opened memory-mapped, also by worker processes)
+    :param years: years to test (defaults to every year of the store); ignored when year_windows is given
+    :param year_windows: optional dict of window name -> years; each year of a window is reported with that
+        window name, so results can be compared across windows such as early and late years
+    :param max_workers: processes to spread rules over (see hbs.parallel.map_tasks)
+    :return: tidy DataFrame with the rule columns, year, cell counts n11, n10, n01, n00 and the test statistics
+    """
+    categories = [categories] if isinstance(categories, str) else list(categories)
+    if years is None and year_windows is None:
+        years = (FlagStore.load(store) if isinstance(store, str) else store).years.tolist()
+    windows = {None: list(years)} if year_windows is None else {name: list(ys) for name, ys in year_windows.items()}
+    years = sorted({year for ys in windows.values() for year in ys})
+    rules = list(itertools.product(arms, seeds, max_death_flags, min_controls))
+    tasks = [(*rule, years, categories) for rule in rules]
+    tables = list(map_tasks(_run_rule, tasks, max_workers=max_workers, initializer=_init_worker, initargs=(store,)))
+
+    # tables are (rule, year, category); reorder to (rule, category, year) to match the key columns
+    tables = np.stack(tables).transpose(0, 2, 1, 3, 4).reshape(-1, 2, 2)
+    keys = pd.DataFrame([(*rule, category, year) for rule in rules for category in categories for year in years],
+                        columns=['arm', 'seed', 'max_death_flag', 'min_controls', 'category', 'year'])
+    counts = pd.DataFrame(tables.reshape(-1, 4), columns=['n11', 'n10', 'n01', 'n00'])
+    results = pd.concat([keys, counts, get_mcnemar_stats(tables).drop(columns=['n10', 'n01'])], axis=1)
+    if year_windows is None:
+        return results
+    window_years = pd.DataFrame([(name, year) for name, ys in windows.items() for year in ys],
+                                columns=['window', 'year'])
+    return window_years.merge(results, on='year')[['window'] + list(results.columns)]
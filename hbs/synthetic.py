@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+from hbs.queries import flag_names
+from hbs.utils import load_local_tables
+
+# share of profiles with each disease at year 1, and annual incidence afterwards
+default_prevalence = {'diabetes': 0.20, 'cardio': 0.25, 'dementia': 0.25}
+default_incidence = {'diabetes': 0.03, 'cardio': 0.04, 'dementia': 0.08}
+
+
+def _onset_year(u, prevalence, incidence):
+    # year of diagnosis from uniforms u: year 1 with probability prevalence, then geometric with rate incidence
+    onset = np.full(u.shape, np.iinfo(np.int32).max, dtype=np.int64)
+    initial = u < prevalence
+    onset[initial] = 1
+    if incidence > 0:
+        # inverse CDF of the geometric distribution on the rescaled uniform
+        v = (u[~initial] - prevalence) / (1 - prevalence)
+        onset[~initial] = 1 + np.ceil(np.log1p(-v) / np.log1p(-incidence)).clip(1, np.iinfo(np.int32).max // 2)
+    return onset
+
+
+def generate_matched_cohort(n_profiles=10000, n_years=30, mean_controls=3, mortality=0.05, prevalence=None,
+                            incidence=None, treatment_risk_ratio=0.8, seed=0):
+    """
+    Generate synthetic matched_profiles, annual_matched_profile_flags and annual_simulated_treatment_flags tables.
+    Every subclass has one treated profile and 1 + Poisson(mean_controls - 1) controls. death_flag is 0 while alive,
+    1 in the year of death and 2 afterwards. Disease flags stay 1 from the year of diagnosis. In the simulated
+    table, treated profiles have their incidence scaled by treatment_risk_ratio, drawn from the same uniforms so
+    the arms differ only by the treatment effect.
+    :param n_profiles: approximate number of profiles
+    :param mortality: annual probability of death
+    :param prevalence: dict of category -> share diagnosed at year 1 (defaults to default_prevalence)
+    :param incidence: dict of category -> annual probability of diagnosis (defaults to default_incidence)
+    :return: dict of table name -> DataFrame
+    """
+    prevalence = {**default_prevalence, **(prevalence or {})}
+    incidence = {**default_incidence, **(incidence or {})}
+    rng = np.random.default_rng(seed)
+    n_subclasses = max(1, round(n_profiles / (1 + mean_controls)))
+    n_controls = 1 + rng.poisson(mean_controls - 1, size=n_subclasses)
+    sizes = 1 + n_controls
+    subclass = np.repeat(np.arange(1, n_subclasses + 1, dtype=np.int32), sizes)
+    # first profile of every subclass is the treated one
+    treated = np.zeros(len(subclass), dtype=np.int8)
+    treated[np.cumsum(sizes) - sizes] = 1
+    profile_id = np.arange(1, len(subclass) + 1, dtype=np.int32)
+    matched_profiles = pd.DataFrame({'profile_id': profile_id, 'subclass': subclass, 'treated': treated})
+
+    year = np.arange(1, n_years + 1, dtype=np.int16)
+    death_year = rng.geometric(mortality, size=len(profile_id)) if mortality > 0 \
+        else np.full(len(profile_id), n_years + 1)
+    death_flag = np.where(year < death_year[:, np.newaxis], 0, np.where(year == death_year[:, np.newaxis], 1, 2))
+    baseline = {'profile_id': np.repeat(profile_id, n_years), 'year': np.tile(year, len(profile_id)),
+                'death_flag': death_flag.astype(np.int8).ravel()}
+    simulated = dict(baseline)
+    for category, flag in flag_names.items():
+        u = rng.random(len(profile_id))
+        onset = _onset_year(u, prevalence[category], incidence[category])
+        onset_simulated = np.where(treated == 1,
+                                   _onset_year(u, prevalence[category], incidence[category] * treatment_risk_ratio),
+                                   onset)
+        baseline[flag] = (year >= onset[:, np.newaxis]).astype(np.int8).ravel()
+        simulated[flag] = (year >= onset_simulated[:, np.newaxis]).astype(np.int8).ravel()
+    return {
+        'matched_profiles': matched_profiles,
+        'annual_matched_profile_flags': pd.DataFrame(baseline),
+        'annual_simulated_treatment_flags': pd.DataFrame(simulated),
+    }
+
+
+def load_synthetic_cohort(engine, **kwargs):
+    """Generate a synthetic cohort (see generate_matched_cohort) and load it into schema hbs of a local engine."""
+    tables = generate_matched_cohort(**kwargs)
+    load_local_tables(engine, tables)
+    return tables
@@ -1,12 +1,36 @@
 import configparser as cp
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine
-from hbs.queries import get_treated_subclass_query, get_control_subclass_query
+from hbs.instrumentation import measure, stage, stage_labels
+from hbs.queries import _quote, _format_years, hbs_tables, flag_names, get_treated_subclass_query, get_control_subclass_query, \
+    get_treated_subclass_years_query, get_control_subclass_years_query, get_control_candidates_query, \
+    get_mcnemar_contingency_query, get_control_pairs_query, get_create_index_query, get_subclass_counts_query
+
+# array statistics live in hbs.stats, which imports without sqlalchemy; re-exported here
+from hbs.stats import get_mcnemar_contingency_table, get_mcnemar_contingency_tables, \
+    get_contingency_tables_from_counts, get_mantel_haenszel_stats, get_mcnemar_stats
+
+
+def set_display_options(max_rows=500, max_columns=500, width=1000):
+    """Widen pandas display of DataFrames for interactive analysis."""
+    pd.set_option('display.max_rows', max_rows)
+    pd.set_option('display.max_columns', max_columns)
+    pd.set_option('display.width', width)
+
+
+def write_atomic(path, write):
+    """
+    Write a file through a temporary file in the same directory, so readers and interrupted runs never see a
+    partial file.
+    :param write: function writing the content to the temporary path it is given
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
 
-pd.set_option('display.max_rows', 500)
-pd.set_option('display.max_columns', 500)
-pd.set_option('display.width', 1000)
 
 def get_mysql_login(access='remote'):
     """
@@ -30,39 +54,463 @@ def get_mysql_login(access='remote'):
     return host, port, user, pwd
 
 
-def create_engine_to_hbs(access='remote'):
+def create_engine_to_hbs(access='remote', pool_size=5, max_overflow=0, path=None, driver='mysqlconnector'):
     """
-    params: access = 'local' or 'remote
+    params: access = 'local' or 'remote' MySQL server, or 'sqlite' / 'duckdb' for a file-backed copy at path
+    params: pool_size, max_overflow = connection pool sizing; fetch_mcnemar_grid runs at most
+        pool_size + max_overflow concurrent fetches
+    params: driver = MySQL driver; streaming reads (get_mcnemar_contingency_table_streaming) need one with
+        server-side cursors, 'pymysql' or 'mysqldb'
     """
+    if access in ('sqlite', 'duckdb'):
+        return create_local_engine(path, backend=access)
+    # sqlalchemy is imported on first use to keep importing hbs.utils light
+    from sqlalchemy import create_engine
     if access == 'remote':
         host, port, user, pwd = get_mysql_login('remote')
     elif access == 'local':
         host, port, user, pwd = get_mysql_login('local')
     dialect = 'mysql'
-    driver = 'mysqlconnector'
     database = 'hbs'
     dbase_url = f"{dialect}+{driver}://{user}:{pwd}@{host}/{database}"
-    return create_engine(dbase_url)
+    return create_engine(dbase_url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
+
+
+def create_local_engine(path, backend='sqlite'):
+    """
+    Create an engine to a file-backed copy of the hbs tables. Query builders render for it via engine.dialect.name.
+    :param path: database file, created if missing; ValueError when None
+    :param backend: 'sqlite' (the file is attached as schema hbs) or 'duckdb' (tables live in schema hbs;
+        requires the duckdb_engine package)
+    """
+    if path is None:
+        raise ValueError(f"a database file path is required for backend {backend!r}")
+    from sqlalchemy import create_engine, event
+    path = str(path)
+    if backend == 'sqlite':
+        engine = create_engine(f"sqlite:///{path}")
+
+        @event.listens_for(engine, 'connect')
+        def attach_hbs(dbapi_connection, connection_record):
+            # bound as a parameter so paths containing quotes attach the same file
+            dbapi_connection.execute("ATTACH DATABASE ? AS hbs", (path,))
+
+    elif backend == 'duckdb':
+        engine = create_engine(f"duckdb:///{path}")
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE SCHEMA IF NOT EXISTS hbs")
+    else:
+        raise ValueError(f"backend must be 'sqlite' or 'duckdb', got {backend!r}")
+    return engine
+
+
+def load_local_tables(engine, tables, if_exists='replace', chunksize=100000):
+    """
+    Write DataFrames into schema hbs of a local engine.
+    :param tables: dict of table name -> DataFrame, e.g. matched_profiles, annual_matched_profile_flags
+    """
+    for name, df in tables.items():
+        df.to_sql(name, con=engine, schema='hbs', index=False, if_exists=if_exists, chunksize=chunksize)
+
+
+def snapshot_hbs_tables(source_engine, local_engine, tables=None, chunksize=100000):
+    """
+    Copy the hbs tables from the MySQL server into a local engine.
+    Annual flag tables are copied one year at a time, so memory is bounded by a year of rows with any driver
+    (mysql-connector buffers whole results client-side); matched_profiles is copied in one read.
+    """
+    dialect = source_engine.dialect.name
+    for name in hbs_tables if tables is None else tables:
+        if name == 'matched_profiles':
+            load_local_tables(local_engine, {name: pd.read_sql(f"SELECT * FROM hbs.{name};", con=source_engine)},
+                              chunksize=chunksize)
+            continue
+        if_exists = 'replace'
+        years = pd.read_sql(f"SELECT DISTINCT {_quote('year', dialect)} FROM hbs.{name};", con=source_engine)
+        for year in sorted(years.iloc[:, 0]):
+            chunk = pd.read_sql(f"SELECT * FROM hbs.{name} WHERE {_quote('year', dialect)} = {int(year)};",
+                                con=source_engine)
+            load_local_tables(local_engine, {name: chunk}, if_exists=if_exists, chunksize=chunksize)
+            if_exists = 'append'
+
 
+def _read_sql(query, engine, cache=None):
+    # read through the result cache when one is given (see hbs.cache.ResultCache)
+    with stage('query', cached=cache is not None) as info:
+        if cache is None:
+            return measure(info, pd.read_sql(query, con=engine))
+        return measure(info, cache.read_sql(query, engine))
+
+
+def _splitmix64(x):
+    # splitmix64 finalizer on uint64 arrays; wraparound is intended
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def get_control_pick_uniforms(seed, year, subclass):
+    """Return reproducible uniforms in [0, 1) hashed from (seed, year, subclass). Arguments broadcast against each other."""
+    h = _splitmix64(np.asarray(seed, dtype=np.int64).astype(np.uint64))
+    h = _splitmix64(h ^ np.asarray(year, dtype=np.int64).astype(np.uint64))
+    h = _splitmix64(h ^ np.asarray(subclass, dtype=np.int64).astype(np.uint64))
+    return (h >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def get_candidate_groups(year, subclass):
+    """
+    Locate the (year, subclass) groups of control candidates sorted by year, subclass and profile_id.
+    year may be a scalar when all candidates belong to one year.
+    :return: arrays of the first position and the size of every group
+    """
+    subclass = np.asarray(subclass)
+    is_start = np.ones(len(subclass), dtype=bool)
+    is_start[1:] = subclass[1:] != subclass[:-1]
+    if np.ndim(year):
+        year = np.asarray(year)
+        is_start[1:] |= year[1:] != year[:-1]
+    starts = np.flatnonzero(is_start)
+    return starts, np.diff(np.append(starts, len(subclass)))
+
+
+def get_control_picks(seed, year, subclass, starts, sizes):
+    """
+    Return the position of the control picked from every group of get_candidate_groups. year and subclass are those
+    of the groups; seed may be a column of draw seeds to pick for several draws at once. This is the pick rule shared
+    by select_controls, hbs.store and hbs.resampling.
+    """
+    u = get_control_pick_uniforms(seed, year, subclass)
+    return starts + (u * sizes).astype(np.int64)
+
+
+def select_controls(candidates, seed=52):
+    """
+    Pick one control per (year, subclass) from all alive control candidates.
+    The pick depends only on the seed and the candidate set, not on row order or database backend.
+    :param candidates: result of get_control_candidates_query
+    :return: one row per (year, subclass), ordered by year and subclass
+    """
+    order = np.lexsort((candidates['profile_id_c'].to_numpy(),
+                        candidates['subclass'].to_numpy(),
+                        candidates['year'].to_numpy()))
+    candidates = candidates.iloc[order].reset_index(drop=True)
+    year = candidates['year'].to_numpy()
+    subclass = candidates['subclass'].to_numpy()
+    starts, sizes = get_candidate_groups(year, subclass)
+    picks = get_control_picks(seed, year[starts], subclass[starts], starts, sizes)
+    return candidates.iloc[picks].reset_index(drop=True)
+
+
+def _pair_key(df, on):
+    # single int64 join key that sorts like the (year, subclass) or (subclass,) columns
+    key = df['subclass'].to_numpy(dtype=np.int64)
+    if list(on) == ['year', 'subclass']:
+        key = (df['year'].to_numpy(dtype=np.int64) << 32) | key
+    elif list(on) != ['subclass']:
+        raise ValueError(f"on must be ['subclass'] or ['year', 'subclass'], got {on!r}")
+    return key
+
+
+def merge_pairs(treated_subclass, control_subclass, on=('subclass',)):
+    """
+    Inner join of treated rows to controls, with the same result as pd.merge(how='inner').
+    The control queries return one row per key in key order, so each treated row is matched with a vectorized
+    binary search (O(n log m), treated rows in any order) instead of building a hash table; unsorted or
+    duplicated control keys fall back to pd.merge.
+    """
+    left_key = _pair_key(treated_subclass, on)
+    right_key = _pair_key(control_subclass, on)
+    if len(right_key) == 0 or not (right_key[1:] > right_key[:-1]).all():
+        return pd.merge(left=treated_subclass, right=control_subclass, how='inner', on=list(on))
+    position = np.searchsorted(right_key, left_key).clip(0, len(right_key) - 1)
+    matched = right_key[position] == left_key
+    overlap = (set(treated_subclass.columns) & set(control_subclass.columns)) - set(on)
+    left = treated_subclass[matched].rename(columns={col: col + '_x' for col in overlap})
+    right = control_subclass.iloc[position[matched]].drop(columns=list(on)) \
+        .rename(columns={col: col + '_y' for col in overlap})
+    return pd.concat([left.reset_index(drop=True), right.reset_index(drop=True)], axis=1)
 
-def get_mcnemar_test_inputs(year, category, engine, baseline=True, ):
-    """Query the database to retrieve disease flags of matched pairs for McNemar analysis."""
-    treated_subclass_query = get_treated_subclass_query(year=year, category=category, baseline=baseline)
-    treated_subclass = pd.read_sql(treated_subclass_query, con=engine)
-    control_subclass_query = get_control_subclass_query(year=year, category=category)
-    control_subclass = pd.read_sql(control_subclass_query, con=engine)
+
+def downcast_pairs(pairs):
+    """
+    Shrink a pairs frame: int32 subclass and profile ids, int8 treated, nullable Int8 disease flags and categorical year.
+    Ids that do not fit in int32 are left as they are.
+    """
+    flag_columns = {flag + suffix for flag in flag_names.values() for suffix in ('_t', '_c')}
+    columns = {}
+    for col in pairs.columns:
+        series = pairs[col]
+        if col == 'year':
+            series = series.astype('category')
+        elif col in ('subclass', 'profile_id_t', 'profile_id_c'):
+            info = np.iinfo(np.int32)
+            if len(series) == 0 or (series.min() >= info.min and series.max() <= info.max):
+                series = series.astype(np.int32)
+        elif col.startswith('treated'):
+            series = series.astype(np.int8)
+        elif col in flag_columns:
+            series = series.astype('Int8')
+        columns[col] = series
+    return pd.DataFrame(columns)
+
+
+def get_control_subclass(years, category, engine, control_sampling='server', seed=52, cache=None):
+    """
+    Retrieve one control per subclass alive in each year.
+    :param control_sampling: 'server' to pick with the RAND(52) window in MySQL, 'client' to fetch all alive controls and pick with select_controls,
+        'table' to read the picks stored by materialize_control_pairs for seed
+    :param seed: seed for client-side sampling
+    :param cache: optional hbs.cache.ResultCache for the query results
+    :return: controls with a year column
+    """
+    if control_sampling == 'server':
+        control_subclass_query = get_control_subclass_years_query(years=years, category=category,
+                                                                  dialect=engine.dialect.name)
+        return _read_sql(control_subclass_query, engine, cache)
+    elif control_sampling == 'client':
+        control_candidates_query = get_control_candidates_query(years=years, category=category,
+                                                                dialect=engine.dialect.name)
+        return select_controls(_read_sql(control_candidates_query, engine, cache), seed=seed)
+    elif control_sampling == 'table':
+        control_pairs_query = get_control_pairs_query(years=years, category=category, seed=seed,
+                                                      dialect=engine.dialect.name)
+        return _read_sql(control_pairs_query, engine, cache)
+    raise ValueError(f"control_sampling must be 'server', 'client' or 'table', got {control_sampling!r}")
+
+
+def materialize_control_pairs(years, engine, seed=52, chunksize=100000):
+    """
+    Pick one control per (year, subclass) with select_controls(seed=seed) and store the picks in
+    hbs.matched_pairs_by_year (seed, year, subclass, profile_id_c), indexed on (seed, year, subclass).
+    Rows of other seeds and years are kept, so the table can hold several seeds; rerun after the flag tables change.
+    Afterwards control_sampling='table' reads the pairing with an indexed join instead of a window query.
+    :return: the stored picks
+    """
+    years = [int(year) for year in years]
+    control_candidates_query = get_control_candidates_query(years=years, category=None, dialect=engine.dialect.name)
+    picks = select_controls(_read_sql(control_candidates_query, engine), seed=seed)
+    pairs = pd.DataFrame({
+        'seed': np.full(len(picks), seed, dtype=np.int64),
+        'year': picks['year'].to_numpy(dtype=np.int32),
+        'subclass': picks['subclass'].to_numpy(dtype=np.int64),
+        'profile_id_c': picks['profile_id_c'].to_numpy(dtype=np.int64),
+    })
+    from sqlalchemy import inspect
+    exists = inspect(engine).has_table('matched_pairs_by_year', schema='hbs')
+    with engine.begin() as conn:
+        if exists:
+            conn.exec_driver_sql(f"DELETE FROM hbs.matched_pairs_by_year WHERE seed = {int(seed)} "
+                                 f"AND {_quote('year', engine.dialect.name)} in ({_format_years(years)});")
+        pairs.to_sql('matched_pairs_by_year', con=conn, schema='hbs', index=False, if_exists='append',
+                     chunksize=chunksize)
+        if not exists:
+            conn.exec_driver_sql(get_create_index_query('matched_pairs_by_year', ['seed', 'year', 'subclass'],
+                                                        dialect=engine.dialect.name))
+    return pairs
+
+
+def get_mcnemar_test_inputs(year, category, engine, baseline=True, control_sampling='server', seed=52, cache=None,
+                            compact=True):
+    """Query the database to retrieve disease flags of matched pairs for McNemar analysis. Pass an hbs.cache.ResultCache as cache to reuse results of identical queries. With compact=True the pairs are downcast by downcast_pairs. category may be a list of categories, or None to fetch every flag column in one pass."""
+    treated_subclass_query = get_treated_subclass_query(year=year, category=category, baseline=baseline,
+                                                        dialect=engine.dialect.name)
+    with stage_labels(side='treated'):
+        treated_subclass = _read_sql(treated_subclass_query, engine, cache)
+    with stage_labels(side='control'):
+        if control_sampling == 'server':
+            control_subclass_query = get_control_subclass_query(year=year, category=category,
+                                                                dialect=engine.dialect.name)
+            control_subclass = _read_sql(control_subclass_query, engine, cache)
+        else:
+            control_subclass = get_control_subclass([year], category, engine, control_sampling=control_sampling,
+                                                    seed=seed, cache=cache).drop(columns='year')
     # combine matched controls to treated subjects.
     # exclude any subclasses with no treated or no control (inner join).
-    pairs = pd.merge(left=treated_subclass, right=control_subclass, how='inner', on='subclass')
+    with stage('merge', year=year, arm='baseline' if baseline else 'simulated') as info:
+        pairs = merge_pairs(treated_subclass, control_subclass, on=['subclass'])
+        return measure(info, downcast_pairs(pairs) if compact else pairs)
+
+
+def get_mcnemar_test_inputs_arms(year, category, engine, arms=('baseline', 'simulated'), control_sampling='server',
+                                 seed=52, cache=None, compact=True):
+    """
+    Retrieve matched pairs for several treatment arms, fetching the control side only once.
+    Controls always come from annual_matched_profile_flags, so every arm is paired with the same controls.
+    :param category: a category, a list of categories, or None for every flag column
+    :param arms: 'baseline' and/or 'simulated'
+    :return: dict of arm -> pairs DataFrame
+    """
+    for arm in arms:
+        if arm not in ('baseline', 'simulated'):
+            raise ValueError(f"arm must be 'baseline' or 'simulated', got {arm!r}")
+    with stage_labels(side='control'):
+        if control_sampling == 'server':
+            control_subclass_query = get_control_subclass_query(year=year, category=category,
+                                                                dialect=engine.dialect.name)
+            control_subclass = _read_sql(control_subclass_query, engine, cache)
+        else:
+            control_subclass = get_control_subclass([year], category, engine, control_sampling=control_sampling,
+                                                    seed=seed, cache=cache).drop(columns='year')
+    pairs = {}
+    for arm in arms:
+        treated_subclass_query = get_treated_subclass_query(year=year, category=category, baseline=arm == 'baseline',
+                                                            dialect=engine.dialect.name)
+        with stage_labels(arm=arm):
+            with stage_labels(side='treated'):
+                treated_subclass = _read_sql(treated_subclass_query, engine, cache)
+            with stage('merge', year=year) as info:
+                pairs[arm] = merge_pairs(treated_subclass, control_subclass, on=['subclass'])
+                if compact:
+                    pairs[arm] = downcast_pairs(pairs[arm])
+                measure(info, pairs[arm])
     return pairs
 
 
-def get_mcnemar_contingency_table(df):
-    """Return 2x2 array of counts for each combination of treated + matched control disease status. Rows of array represent control status ordered by status=1, status=0. Columns represent status of treated ordered by status=1, status=0. """
-    # assign contingency table bucket group
-    df['contingency_table_cell'] = df.apply(lambda row: str(row['dementia_flag_c']) + str(row['dementia_flag_t']), axis=1)
-    contingency_table = np.array([(df.loc[df['contingency_table_cell'] == '11', 'subclass'].count(),
-                               df.loc[df['contingency_table_cell'] == '10', 'subclass'].count()),
-                              (df.loc[df['contingency_table_cell'] == '01', 'subclass'].count(),
-                               df.loc[df['contingency_table_cell'] == '00', 'subclass'].count())])
-    return contingency_table
\ No newline at end of file
+def _pool_capacity(engine):
+    # connections the engine's pool hands out at once, or None when it is unbounded
+    pool = engine.pool
+    if not hasattr(pool, 'size') or getattr(pool, '_max_overflow', 0) < 0:
+        return None
+    return pool.size() + pool._max_overflow
+
+
+def fetch_mcnemar_grid(grid, engine, max_workers=4, control_sampling='server', seed=52, cache=None):
+    """
+    Fetch matched pairs for a grid of (year, category, arm) cells on a bounded thread pool.
+    Cells sharing a (year, category) are fetched together so their control side is queried once.
+    :param grid: iterable of (year, category, arm) tuples; category may be a list of categories
+    :param engine: shared engine (see create_engine_to_hbs for its pool sizing)
+    :param max_workers: number of concurrent fetches, capped at the connections the engine's pool can hand out
+        so no fetch waits on the pool
+    :return: list of pairs DataFrames in the order of grid
+    """
+    # lists of categories become tuples so cells can be grouped by (year, category)
+    grid = [(year, tuple(category) if isinstance(category, list) else category, arm) for year, category, arm in grid]
+    capacity = _pool_capacity(engine)
+    if capacity is not None and max_workers is not None:
+        max_workers = min(max_workers, capacity)
+    arms_by_key = {}
+    for year, category, arm in grid:
+        arms = arms_by_key.setdefault((year, category), [])
+        if arm not in arms:
+            arms.append(arm)
+
+    def fetch(key):
+        year, category = key
+        with stage_labels(year=year, category=category):
+            return get_mcnemar_test_inputs_arms(year, category, engine, arms=arms_by_key[key],
+                                                control_sampling=control_sampling, seed=seed, cache=cache)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fetched = dict(zip(arms_by_key, executor.map(fetch, arms_by_key)))
+    return [fetched[(year, category)][arm] for year, category, arm in grid]
+
+
+def get_mcnemar_test_inputs_bulk(years, category, engine, baseline=True, control_sampling='server', seed=52,
+                                 cache=None, compact=True):
+    """
+    Retrieve matched pairs for several years with one query per side instead of one per year.
+    With control_sampling='server' on MySQL the controls are ordered by RAND(52) partitioned by (year, subclass)
+    over all years at once, so they differ from the per-year draws of get_mcnemar_test_inputs behind data/*.csv.
+    Use 'client' or 'table' for picks that do not depend on how years are batched.
+    :param years: list or range of years
+    :return: dict of year -> pairs DataFrame, each with a year column
+    """
+    treated_subclass_query = get_treated_subclass_years_query(years=years, category=category, baseline=baseline,
+                                                              dialect=engine.dialect.name)
+    treated_subclass = _read_sql(treated_subclass_query, engine, cache)
+    control_subclass = get_control_subclass(years, category, engine, control_sampling=control_sampling, seed=seed,
+                                            cache=cache)
+    with stage('merge', arm='baseline' if baseline else 'simulated') as info:
+        pairs = merge_pairs(treated_subclass, control_subclass, on=['year', 'subclass'])
+        if compact:
+            pairs = downcast_pairs(pairs)
+        measure(info, pairs)
+    by_year = {year: group.reset_index(drop=True) for year, group in pairs.groupby('year', sort=True, observed=True)}
+    # keep years with no pairs so callers can index every requested year
+    return {year: by_year.get(year, pairs.iloc[:0]) for year in years}
+
+
+def get_mcnemar_contingency_counts(years, category, engine, baseline=True, cache=None):
+    """Query the database for the per-year 2x2 cell counts of matched pairs, aggregated server-side."""
+    contingency_query = get_mcnemar_contingency_query(years=years, category=category, baseline=baseline,
+                                                      dialect=engine.dialect.name)
+    return _read_sql(contingency_query, engine, cache)
+
+
+def get_subclass_counts(years, category, engine, baseline=True, cache=None):
+    """Query the database for the number of alive treated and control profiles per year, subclass and flag, using every control."""
+    subclass_counts_query = get_subclass_counts_query(years=years, category=category, baseline=baseline,
+                                                      dialect=engine.dialect.name)
+    return _read_sql(subclass_counts_query, engine, cache)
+
+
+def _read_sql_chunks(query, engine, chunksize):
+    # stream a query in DataFrame chunks over a server-side cursor. SQLite and DuckDB cursors fetch lazily;
+    # other drivers without server-side cursors (e.g. mysql+mysqlconnector) would silently ignore stream_results
+    # and buffer the whole result client-side, so they are rejected up front
+    if engine.dialect.name not in ('sqlite', 'duckdb') and not engine.dialect.supports_server_side_cursors:
+        raise ValueError(f"{engine.dialect.name}+{engine.dialect.driver} has no server-side cursors and would buffer "
+                         f"the whole result; use create_engine_to_hbs(driver='pymysql') or driver='mysqldb'")
+
+    def chunks():
+        with engine.connect().execution_options(stream_results=True) as conn:
+            yield from pd.read_sql(query, con=conn, chunksize=chunksize)
+
+    return chunks()
+
+
+def get_mcnemar_contingency_table_streaming(year, category, engine, baseline=True, chunksize=50000, na='drop'):
+    """
+    Same result as get_mcnemar_contingency_table(get_mcnemar_test_inputs(...)) with memory bounded by chunksize.
+    Treated and control rows are streamed in subclass order and merge-joined chunk by chunk,
+    folding each joined chunk into running 2x2 counts.
+    On MySQL this needs a driver with server-side cursors (see create_engine_to_hbs); ValueError otherwise.
+    """
+    treated_subclass_query = get_treated_subclass_query(year=year, category=category, baseline=baseline,
+                                                        order_by_subclass=True, dialect=engine.dialect.name)
+    control_subclass_query = get_control_subclass_query(year=year, category=category, dialect=engine.dialect.name)
+    streams = {'t': _read_sql_chunks(treated_subclass_query, engine, chunksize),
+               'c': _read_sql_chunks(control_subclass_query, engine, chunksize)}
+    buffers = {'t': None, 'c': None}
+    last_subclass = {'t': None, 'c': None}
+    done = {'t': False, 'c': False}
+    contingency_table = np.zeros((2, 2), dtype=np.int64)
+
+    def fold(treated_subclass, control_subclass):
+        pairs = pd.merge(left=treated_subclass, right=control_subclass, how='inner', on='subclass')
+        return get_mcnemar_contingency_table(pairs, category=category, na=na)
+
+    def exhausted(side):
+        # a finished side with nothing buffered can match no further rows, so the other side need not be read
+        return done[side] and (buffers[side] is None or len(buffers[side]) == 0)
+
+    while not (done['t'] and done['c']) and not (exhausted('t') or exhausted('c')):
+        # read from the side that is furthest behind in subclass order
+        pending = [side for side in ('t', 'c') if not done[side]]
+        side = min(pending, key=lambda k: -np.inf if last_subclass[k] is None else last_subclass[k])
+        try:
+            chunk = next(streams[side])
+        except StopIteration:
+            done[side] = True
+            continue
+        if len(chunk) == 0:
+            continue
+        buffers[side] = chunk if buffers[side] is None else pd.concat([buffers[side], chunk], ignore_index=True)
+        last_subclass[side] = chunk['subclass'].iloc[-1]
+        if buffers['t'] is None or buffers['c'] is None:
+            continue
+        # subclasses below the last one seen on both open sides can receive no more rows
+        boundary = min(np.inf if done[k] else last_subclass[k] for k in ('t', 'c'))
+        ready = {k: (buffers[k]['subclass'] < boundary).to_numpy() for k in ('t', 'c')}
+        contingency_table += fold(buffers['t'][ready['t']], buffers['c'][ready['c']])
+        for k in ('t', 'c'):
+            buffers[k] = buffers[k][~ready[k]].reset_index(drop=True)
+    if buffers['t'] is not None and buffers['c'] is not None:
+        contingency_table += fold(buffers['t'], buffers['c'])
+    for stream in streams.values():
+        stream.close()
+    return contingency_table
@@ -1,13 +1,9 @@
 # Run matched case control McNemar tests on baseline and simulated treatment profiles
 
-import pandas as pd
-from statsmodels.stats.contingency_tables import mcnemar
-from collections import defaultdict
-from hbs.utils import create_engine_to_hbs, get_mcnemar_test_inputs, get_mcnemar_contingency_table
+from hbs.utils import create_engine_to_hbs, set_display_options
+from hbs.pipeline import run_mcnemar_series, get_contingency_table_frame
 
-pd.set_option('display.max_rows', 500)
-pd.set_option('display.max_columns', 500)
-pd.set_option('display.width', 1000)
+set_display_options()
 # pd.set_option('display.float_format', '{:,.4f}'.format)  # display 2 decimal places and use ',' thousands separator
 
 # set environment variables
@@ -23,26 +19,19 @@ engine = create_engine_to_hbs(access=hbs_env)
 # The rejection condition is one sided. The test statistic should be greater than 1 - alpha % of the chi-square distribution.
 # Another way to describe the chi-square test: The p-value gives the probability of obtaining the observed frequencies if the expected frequencies are equal (H0: f1 = f2 = 0.5).
 
+# fetch both arms for all years; the control side is shared, so it is queried once per year
+category = 'dementia'
+results = run_mcnemar_series(years=range(1,31), categories=[category], arms=['baseline', 'simulated'], engine=engine)
+stats = results['stats']
+tables = results['tables']
+
 # Baseline McNemar tests
-baseline_mcnemar_stats = defaultdict(list)
-contingency_tables_baseline = {}
-baseline_inputs_df = pd.DataFrame()
-for year in range(1,31):
-    category = 'dementia'
-    inputs = get_mcnemar_test_inputs(year=year, category=category, engine=engine, baseline=True)
-    inputs['year'] = year
-    baseline_inputs_df = pd.concat([baseline_inputs_df, inputs])
-    contingency_table = get_mcnemar_contingency_table(inputs)
-    contingency_tables_baseline[year] = pd.DataFrame(
-        contingency_table,
-        index=pd.MultiIndex.from_tuples([('Control Group', 'Dementia'), ('Control Group', 'No Dementia')]),
-        columns=pd.MultiIndex.from_tuples([('Treated Group', 'Dementia'), ('Treated Group', 'No Dementia')])
-    )
-    mcnemar_test = mcnemar(contingency_table, exact=False, correction=True)
-    baseline_mcnemar_stats['year'].append(year)
-    baseline_mcnemar_stats['pvalue'].append(mcnemar_test.pvalue)
-    baseline_mcnemar_stats['statistic'].append(mcnemar_test.statistic)
-baseline_mcnemar_df = pd.DataFrame(baseline_mcnemar_stats)
+baseline_inputs_df = results['inputs']['baseline']
+baseline_mcnemar_df = stats.loc[stats['arm'] == 'baseline', ['year', 'pvalue', 'statistic']].reset_index(drop=True)
+contingency_tables_baseline = {
+    row.year: get_contingency_table_frame([[row.n11, row.n10], [row.n01, row.n00]], category)
+    for row in tables[tables['arm'] == 'baseline'].itertuples()
+}
 # observations: all tests fail to reject the null hypothesis at alpha=0.05.
 #     year    pvalue  statistic
 # 0      1  0.106674   2.602815
@@ -262,25 +251,12 @@ for year in contingency_tables_baseline.keys():
 # __________________________________________________
 
 ## Simulated Treatment McNemar Tests
-simulated_mcnemar_stats = defaultdict(list)
-contingency_tables_simulated = {}
-sim_inputs_df = pd.DataFrame()
-for year in range(1,31):
-    category = 'dementia'
-    inputs = get_mcnemar_test_inputs(year=year, category=category, engine=engine, baseline=False)
-    inputs['year'] = year
-    sim_inputs_df = pd.concat([sim_inputs_df, inputs])
-    contingency_table = get_mcnemar_contingency_table(inputs)
-    contingency_tables_simulated[year] = pd.DataFrame(
-        contingency_table,
-        index=pd.MultiIndex.from_tuples([('Control Group', 'Dementia'), ('Control Group', 'No Dementia')]),
-        columns=pd.MultiIndex.from_tuples([('Treated Group', 'Dementia'), ('Treated Group', 'No Dementia')])
-    )
-    mcnemar_test = mcnemar(contingency_table, exact=False, correction=True)
-    simulated_mcnemar_stats['year'].append(year)
-    simulated_mcnemar_stats['pvalue'].append(mcnemar_test.pvalue)
-    simulated_mcnemar_stats['statistic'].append(mcnemar_test.statistic)
-simulated_mcnemar_df = pd.DataFrame(simulated_mcnemar_stats)
+sim_inputs_df = results['inputs']['simulated']
+simulated_mcnemar_df = stats.loc[stats['arm'] == 'simulated', ['year', 'pvalue', 'statistic']].reset_index(drop=True)
+contingency_tables_simulated = {
+    row.year: get_contingency_table_frame([[row.n11, row.n10], [row.n01, row.n00]], category)
+    for row in tables[tables['arm'] == 'simulated'].itertuples()
+}
 # mcnemar tests detected prevention in the simulated treatment arm every year except year 1.
 #     year        pvalue   statistic
 # 0      1  3.466172e-01    0.885803
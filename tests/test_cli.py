@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+import hbs.cli
+from hbs.cli import main, run_grid
+from hbs.synthetic import load_synthetic_cohort
+from hbs.utils import create_local_engine
+
+years = [1, 2, 3, 4]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'hbs.db')
+    engine = create_local_engine(path)
+    load_synthetic_cohort(engine, n_profiles=2000, n_years=len(years), seed=0)
+    engine.dispose()
+    return path
+
+
+def test_rerun_computes_only_missing_years(db_path, tmp_path, monkeypatch):
+    kwargs = dict(access='sqlite', path=db_path, date='2024-10-18', max_workers=1)
+    run_year = hbs.cli._run_year
+
+    def interrupted(year, *args):
+        if year == 3:
+            raise KeyboardInterrupt
+        return run_year(year, *args)
+
+    monkeypatch.setattr(hbs.cli, '_run_year', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run_grid(years, ['dementia'], ['baseline'], output_dir=str(tmp_path / 'out'), **kwargs)
+    monkeypatch.setattr(hbs.cli, '_run_year', run_year)
+
+    written, computed = run_grid(years, ['dementia'], ['baseline'], output_dir=str(tmp_path / 'out'), **kwargs)
+    assert computed == [3, 4]
+    fresh, _ = run_grid(years, ['dementia'], ['baseline'], output_dir=str(tmp_path / 'fresh'), **kwargs)
+    pd.testing.assert_frame_equal(pd.read_csv(written['baseline']), pd.read_csv(fresh['baseline']))
+    assert run_grid(years, ['dementia'], ['baseline'], output_dir=str(tmp_path / 'out'), **kwargs)[1] == []
+
+
+def test_main_reports_checkpointed_years(db_path, tmp_path, capsys):
+    argv = ['--access', 'sqlite', '--path', db_path, '--years', '1-4', '--arms', 'baseline', '--workers', '1',
+            '--output-dir', str(tmp_path), '--date', '2024-10-18']
+    assert main(argv) == 0
+    assert '0 of 4 years checkpointed; computed 4' in capsys.readouterr().out
+    assert main(argv) == 0
+    assert '4 of 4 years checkpointed; computed 0' in capsys.readouterr().out
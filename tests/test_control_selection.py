@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from hbs.resampling import fetch_resampling_data, draw_contingency_tables
+from hbs.store import FlagStore
+from hbs.synthetic import load_synthetic_cohort
+from hbs.utils import create_local_engine, get_mcnemar_test_inputs, get_mcnemar_contingency_table
+
+years = [1, 2, 3]
+
+
+@pytest.fixture(scope='module')
+def engine(tmp_path_factory):
+    engine = create_local_engine(str(tmp_path_factory.mktemp('cohort') / 'hbs.db'))
+    load_synthetic_cohort(engine, n_profiles=2000, n_years=len(years), seed=0)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize('seed', [52, 7])
+def test_control_picks_agree(engine, seed):
+    # client sampling picks controls with select_controls
+    selected = np.stack([get_mcnemar_contingency_table(get_mcnemar_test_inputs(year, 'dementia', engine,
+                                                                               control_sampling='client', seed=seed),
+                                                       category='dementia') for year in years])
+    data = fetch_resampling_data(years, ['dementia'], ['baseline'], engine)[('baseline', 'dementia')]
+    resampled = draw_contingency_tables(data, [seed])[0]
+    stored = FlagStore.from_engine(engine, years, arms=('baseline',)).contingency_tables(years, 'dementia', seed=seed)
+    assert data['years'].tolist() == years
+    np.testing.assert_array_equal(resampled, selected)
+    np.testing.assert_array_equal(stored, selected)
@@ -0,0 +1,21 @@
+import pandas as pd
+import pytest
+from hbs.utils import create_engine_to_hbs, load_local_tables
+
+
+@pytest.mark.parametrize('access', ['sqlite', 'duckdb'])
+def test_local_access_requires_path(access, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError, match='path'):
+        create_engine_to_hbs(access=access)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sqlite_path_with_quotes(tmp_path):
+    path = tmp_path / "o'brien's hbs.db"
+    engine = create_engine_to_hbs(access='sqlite', path=str(path))
+    load_local_tables(engine, {'matched_profiles': pd.DataFrame({'profile_id': [1, 2], 'subclass': 1,
+                                                                 'treated': [1, 0]})})
+    assert pd.read_sql("SELECT count(*) AS n FROM hbs.matched_profiles;", con=engine)['n'].iloc[0] == 2
+    engine.dispose()
+    assert path.exists()
@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+from hbs.cache import ResultCache
+from hbs.incremental import refresh_mcnemar_results
+from hbs.synthetic import load_synthetic_cohort
+from hbs.utils import create_local_engine
+
+years = [1, 2, 3, 4]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_local_engine(str(tmp_path / 'hbs.db'))
+    load_synthetic_cohort(engine, n_profiles=2000, n_years=len(years), seed=0)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_refresh_recomputes_changed_year(engine, tmp_path, use_cache):
+    if use_cache:
+        pytest.importorskip('pyarrow')
+    cache = ResultCache(str(tmp_path / 'cache')) if use_cache else None
+    results_path = str(tmp_path / 'simulated_mcnemar_results.csv')
+    before, changed = refresh_mcnemar_results(results_path, years, 'dementia', 'simulated', engine, max_workers=1,
+                                              cache=cache)
+    assert changed == [('dementia', year) for year in years]
+
+    # flip the dementia flag of the treated profiles in year 3
+    with engine.begin() as conn:
+        conn.exec_driver_sql("UPDATE hbs.annual_simulated_treatment_flags SET dementia_flag = 1 - dementia_flag "
+                             "WHERE year = 3 AND profile_id IN "
+                             "(SELECT profile_id FROM hbs.matched_profiles WHERE treated = 1);")
+    after, changed = refresh_mcnemar_results(results_path, years, 'dementia', 'simulated', engine, max_workers=1,
+                                             cache=cache)
+    assert changed == [('dementia', 3)]
+    fresh, _ = refresh_mcnemar_results(str(tmp_path / 'fresh.csv'), years, 'dementia', 'simulated', engine,
+                                       max_workers=1)
+    pd.testing.assert_frame_equal(after, fresh)
+    unchanged = before['year'] != 3
+    pd.testing.assert_frame_equal(after[unchanged], before[unchanged])
+    assert after.loc[2, 'pvalue'] != before.loc[2, 'pvalue']
+
+    # the stored fingerprints are current, so nothing is left to recompute
+    assert refresh_mcnemar_results(results_path, years, 'dementia', 'simulated', engine, max_workers=1,
+                                   cache=cache)[1] == []
@@ -0,0 +1,25 @@
+import pytest
+from hbs.indexes import advise_indexes, propose_indexes, create_indexes
+from hbs.synthetic import load_synthetic_cohort
+from hbs.utils import create_local_engine
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_local_engine(str(tmp_path / 'hbs.db'))
+    load_synthetic_cohort(engine, n_profiles=2000, n_years=3, seed=0)
+    yield engine
+    engine.dispose()
+
+
+def test_create_indexes_resolves_proposals(engine):
+    issues = advise_indexes(engine)
+    assert issues['issue'].isin(['full scan', 'automatic index']).any()
+
+    proposed = propose_indexes(engine)
+    assert proposed
+    assert create_indexes(engine) == proposed
+    assert propose_indexes(engine) == []
+    after = advise_indexes(engine)
+    assert not (after['issue'] == 'automatic index').any()
+    assert (after['issue'] == 'full scan').sum() < (issues['issue'] == 'full scan').sum()
@@ -0,0 +1,34 @@
+import time
+import pandas as pd
+from hbs.instrumentation import measure, recording, stage
+from hbs.synthetic import load_synthetic_cohort
+from hbs.utils import create_local_engine, get_mcnemar_test_inputs_arms
+
+
+class SlowFrame(pd.DataFrame):
+    # a frame that takes a while to size, like one with many deep object columns
+    def memory_usage(self, *args, **kwargs):
+        time.sleep(0.2)
+        return super().memory_usage(*args, **kwargs)
+
+
+def test_measure_is_not_timed():
+    df = SlowFrame({'a': range(10)})
+    with recording() as recorder:
+        with stage('query') as info:
+            measure(info, df)
+    record, = recorder.records
+    assert record['rows'] == 10 and record['bytes'] > 0
+    assert record['seconds'] < 0.1
+
+
+def test_arms_queries_are_labelled_by_side(tmp_path):
+    engine = create_local_engine(str(tmp_path / 'hbs.db'))
+    load_synthetic_cohort(engine, n_profiles=500, n_years=1, seed=0)
+    with recording() as recorder:
+        get_mcnemar_test_inputs_arms(1, 'dementia', engine)
+    engine.dispose()
+    queries = recorder.to_frame().query("stage == 'query'")
+    assert sorted(zip(queries['side'], queries['arm'].fillna(''))) == \
+        [('control', ''), ('treated', 'baseline'), ('treated', 'simulated')]
+    assert (queries['rows'] > 0).all()
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+from hbs.utils import merge_pairs
+
+
+def frames(on):
+    rng = np.random.default_rng(0)
+    # treated rows in random order, some in subclasses without a control and vice versa
+    treated = pd.DataFrame({'year': rng.integers(1, 4, 300), 'subclass': rng.integers(1, 60, 300), 'treated': 1,
+                            'profile_id_t': np.arange(300), 'dementia_flag_t': rng.integers(0, 2, 300)})
+    keys = pd.DataFrame([(year, subclass) for year in (1, 2, 3) for subclass in range(5, 80)],
+                        columns=['year', 'subclass'])
+    if on == ['subclass']:
+        treated = treated.drop(columns='year')
+        keys = keys[keys['year'] == 1].drop(columns='year')
+    keys = keys.sample(frac=0.7, random_state=0).sort_values(on, ignore_index=True)
+    control = keys.assign(treated=0, profile_id_c=1000 + np.arange(len(keys)),
+                          dementia_flag_c=rng.integers(0, 2, len(keys)))
+    return treated, control
+
+
+@pytest.mark.parametrize('on', [['subclass'], ['year', 'subclass']])
+def test_merge_pairs_matches_pd_merge(on):
+    treated, control = frames(on)
+    expected = pd.merge(left=treated, right=control, how='inner', on=on)
+    assert 0 < len(expected) < len(treated)
+    result = merge_pairs(treated, control, on=on)
+    assert {'treated_x', 'treated_y'} <= set(result.columns)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize('change', ['duplicate', 'unsorted', 'empty'])
+def test_merge_pairs_falls_back_on_unordered_controls(change):
+    treated, control = frames(['subclass'])
+    if change == 'duplicate':
+        control = pd.concat([control, control.iloc[[3]]]).sort_values('subclass', kind='stable', ignore_index=True)
+    elif change == 'unsorted':
+        control = control.sample(frac=1, random_state=1, ignore_index=True)
+    else:
+        control = control.iloc[:0]
+    expected = pd.merge(left=treated, right=control, how='inner', on=['subclass'])
+    pd.testing.assert_frame_equal(merge_pairs(treated, control), expected)
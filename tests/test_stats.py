@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from hbs.stats import get_mcnemar_stats, _check_mcnemar_stats
+
+pytest.importorskip('statsmodels')
+
+# discordant counts n10 + n01 of zero, small (exact binomial range) and large
+tables = np.array([
+    [[5, 0], [0, 7]],
+    [[3, 1], [0, 9]],
+    [[10, 2], [7, 30]],
+    [[0, 12], [12, 0]],
+    [[40, 20], [3, 100]],
+    [[321, 898], [972, 2809]],
+    [[10000, 52000], [50000, 900000]],
+])
+
+
+def test_mcnemar_stats_match_statsmodels():
+    stats = get_mcnemar_stats(tables, check=True)
+    assert len(stats) == len(tables)
+    np.testing.assert_array_equal(stats['n10'], tables[:, 0, 1])
+    np.testing.assert_array_equal(stats['n01'], tables[:, 1, 0])
+
+
+def test_mcnemar_stats_single_table():
+    stats = get_mcnemar_stats(tables[2], check=True)
+    assert len(stats) == 1
+    # 2 against 7 discordant pairs: exact two-sided binomial p-value
+    assert stats['pvalue_exact'].iloc[0] == pytest.approx(0.1796875)
+
+
+def test_check_detects_mismatch():
+    stats = get_mcnemar_stats(tables)
+    stats.loc[4, 'pvalue_exact'] *= 1.01
+    with pytest.raises(AssertionError, match='pvalue_exact'):
+        _check_mcnemar_stats(tables, stats)
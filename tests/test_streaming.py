@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import hbs.utils
+from hbs.synthetic import load_synthetic_cohort
+from hbs.utils import create_local_engine, get_mcnemar_test_inputs, get_mcnemar_contingency_table, \
+    get_mcnemar_contingency_table_streaming
+
+years = [1, 2, 3]
+
+
+@pytest.fixture(scope='module')
+def engine(tmp_path_factory):
+    engine = create_local_engine(str(tmp_path_factory.mktemp('cohort') / 'hbs.db'))
+    load_synthetic_cohort(engine, n_profiles=2000, n_years=len(years), seed=0)
+    with engine.begin() as conn:
+        # NULL flags on both sides, which the tables drop pair by pair
+        for table in ('annual_matched_profile_flags', 'annual_simulated_treatment_flags'):
+            conn.exec_driver_sql(f"UPDATE hbs.{table} SET dementia_flag = NULL WHERE profile_id % 17 = 0;")
+        # year 3 has no simulated treatment rows
+        conn.exec_driver_sql("DELETE FROM hbs.annual_simulated_treatment_flags WHERE year = 3;")
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize('baseline', [True, False])
+@pytest.mark.parametrize('year', years)
+def test_streaming_matches_in_memory(engine, year, baseline):
+    pairs = get_mcnemar_test_inputs(year, 'dementia', engine, baseline=baseline)
+    expected = get_mcnemar_contingency_table(pairs, category='dementia')
+    streamed = get_mcnemar_contingency_table_streaming(year, 'dementia', engine, baseline=baseline, chunksize=64)
+    np.testing.assert_array_equal(streamed, expected)
+
+
+def test_streaming_stops_when_one_side_is_empty(engine, monkeypatch):
+    read_sql_chunks = hbs.utils._read_sql_chunks
+    # rows read per query, treated first
+    consumed = []
+
+    def counting_chunks(query, engine, chunksize):
+        side = len(consumed)
+        consumed.append(0)
+
+        def chunks():
+            for chunk in read_sql_chunks(query, engine, chunksize):
+                consumed[side] += len(chunk)
+                yield chunk
+
+        return chunks()
+
+    monkeypatch.setattr(hbs.utils, '_read_sql_chunks', counting_chunks)
+    streamed = get_mcnemar_contingency_table_streaming(3, 'dementia', engine, baseline=False, chunksize=64)
+    np.testing.assert_array_equal(streamed, np.zeros((2, 2), dtype=np.int64))
+    # the treated side returns no rows, so at most one chunk of controls is read
+    assert consumed[0] == 0 and consumed[1] <= 64